@@ -1,24 +1,42 @@
 import base64
-import boto3
+import concurrent.futures
+import io
 import json
 import os
+import ledger
+from model_routing import converse_with_routing, record_routing_stats
+from startup import lazy_client, lazy_resource, load_template, run_at_init
 
-bedrock = boto3.client(service_name='bedrock-runtime',
-                       region_name=os.environ['AWS_REGION'])
-s3 = boto3.resource('s3')
-ddb = boto3.client('dynamodb')
+bedrock = lazy_client(service_name='bedrock-runtime',
+                      region_name=os.environ['AWS_REGION'])
+s3 = lazy_resource('s3')
+ddb = lazy_client('dynamodb')
 
 model_id = os.environ["ModelId"]
+# Optional cheaper model tried first, escalating to ModelId for invalid or sparse attributions
+fast_model_id = os.environ.get("FastModelId", "")
+min_completeness = float(os.environ.get("MinCompleteness", "0.6"))
+# Attributes every item of the use case has, attributes that don't apply are left empty and not scored
+core_attributes = os.environ.get(
+    "CoreAttributes", "room_type,bed_size,decor_style,room_view,lighting,flooring,windows").split(",")
+routing_stats_table_name = os.environ.get("RoutingStatsTableName", "")
+# "tool" constrains the output with Converse tool use, "text" parses and repairs the free text completion
+output_mode = os.environ.get("OutputMode", "text")
 bucket_name = os.environ["ImageBucketName"]
+# Down-selection of near-duplicate images before they are sent to the model
+max_images = int(os.environ.get("MaxImages", "5"))
+image_token_budget = int(os.environ.get("ImageTokenBudget", "0"))
+max_image_edge = int(os.environ.get("MaxImageEdge", "1024"))
+duplicate_threshold = int(os.environ.get("DuplicateThreshold", "10"))
 
-templates = {}
 
-# Iterate through all template files and populate templates dictionary
-for filename in os.listdir('.'):
-    if filename.endswith('-template.txt'):
-        template_name = filename.replace('-template.txt', '')
-        with open(filename, 'r') as file:
-            templates[template_name] = file.read()
+def prime():
+    # Import Pillow and load the templates at import time in eager startup mode, the clients exist already
+    import PIL.Image
+    load_template('hospitality')
+
+
+run_at_init(prime)
 
 
 def read_as_base64(bucket, key):
@@ -27,10 +45,99 @@ def read_as_base64(bucket, key):
     return base64.b64encode(obj['Body'].read()).decode('utf-8')
 
 
+def fetch_images(bucket, keys):
+    # read all images from s3 bucket concurrently, keeping the order of keys
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(10, len(keys)))) as executor:
+        return list(executor.map(lambda key: base64.b64decode(read_as_base64(bucket, key)), keys))
+
+
+def image_signature(image):
+    """
+    Difference hash of an image, a 64 bit perceptual signature that is equal for near identical images
+    """
+    from PIL import Image
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    signature = 0
+    for row in range(8):
+        for col in range(8):
+            signature = (signature << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return signature
+
+
+def image_information(image):
+    """
+    Entropy of the grayscale histogram, used to prefer the most detailed image of a cluster
+    """
+    return image.convert("L").entropy()
+
+
+def select_images(paths, images):
+    """
+    Cluster near-identical images and keep the most informative image of each cluster
+
+    Images are downscaled to max_image_edge and at most max_images are kept, staying within
+    image_token_budget input tokens when a budget is configured.
+
+    Args:
+        paths: S3 keys of the images
+        images: Image bytes in the same order as paths
+
+    Returns:
+        List of (path, format, bytes) tuples in the original order of paths
+    """
+    from PIL import Image
+    candidates = []
+    for index, (path, image_bytes) in enumerate(zip(paths, images)):
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            original_size = image.size
+            # JPEGs are decoded at a reduced scale that is still at least max_image_edge, which keeps
+            # the memory of large phone photos low
+            if image.format == "JPEG":
+                image.draft("RGB", (max_image_edge, max_image_edge))
+            image.load()
+        extension = path.split(".")[-1].lower()
+        if extension == "jpg":
+            extension = "jpeg"
+        if max(original_size) > max_image_edge:
+            image.thumbnail((max_image_edge, max_image_edge), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            image.convert("RGB").save(buffer, format="JPEG", quality=85)
+            image_bytes, extension = buffer.getvalue(), "jpeg"
+        candidates.append({
+            "index": index,
+            "path": path,
+            "format": extension,
+            "bytes": image_bytes,
+            "signature": image_signature(image),
+            "information": image_information(image),
+            # Approximate input tokens of an image for the Converse API
+            "tokens": image.width * image.height // 750
+        })
+
+    # Greedy clustering, most informative images first become cluster representatives
+    representatives = []
+    for candidate in sorted(candidates, key=lambda c: c["information"], reverse=True):
+        if all(bin(candidate["signature"] ^ r["signature"]).count("1") > duplicate_threshold for r in representatives):
+            representatives.append(candidate)
+
+    selected = []
+    tokens = 0
+    for candidate in representatives[:max_images]:
+        if image_token_budget and selected and tokens + candidate["tokens"] > image_token_budget:
+            continue
+        selected.append(candidate)
+        tokens += candidate["tokens"]
+    print(f"Selected {len(selected)} of {len(paths)} images, approximately {tokens} image tokens")
+    return [(c["path"], c["format"], c["bytes"]) for c in sorted(selected, key=lambda c: c["index"])]
+
+
+@ledger.recorded("generic-attribution", lambda event: (event["data"]["id"], event["executionId"]),
+                 clients=[bedrock, s3])
 def lambda_handler(event, context):
     print(json.dumps(event))
-    prompt = templates[event["data"]["useCase"].lower()]
+    prompt, schema = load_template(event["data"]["useCase"].lower())
     id = event["data"]["id"]
+    ledger.set_category(event["data"]["useCase"])
 
     ddb.put_item(
         TableName=os.environ["TableName"],
@@ -43,18 +150,17 @@ def lambda_handler(event, context):
         }
     )
 
-    # Prepare the content for Converse API
+    # Prepare the content for Converse API with the representative images only
     content = []
+    images = fetch_images(bucket_name, event["data"]["paths"])
+    selected_images = select_images(event["data"]["paths"], images)
 
-    for i in event["data"]["paths"]:
-        extension = i.split(".")[-1]
-        if extension.lower() == "jpg":
-            extension = "jpeg"
+    for path, extension, image_bytes in selected_images:
         content.append({
             "image": {
                 "format": extension,
                 "source": {
-                    "bytes": base64.b64decode(read_as_base64(bucket_name, i))
+                    "bytes": image_bytes
                 }
             }
         })
@@ -63,33 +169,41 @@ def lambda_handler(event, context):
         "text": prompt
     })
 
-    # Make the API call using Converse API
-    response = bedrock.converse(
-        modelId=model_id,
+    # Make the API call using Converse API, trying the fast model first when configured
+    model_tiers = [fast_model_id, model_id] if fast_model_id and fast_model_id != model_id else [model_id]
+    result = converse_with_routing(
+        bedrock,
+        model_tiers,
         messages=[
             {
                 "role": "user",
                 "content": content
             }
         ],
-        inferenceConfig={
+        schema=schema,
+        min_completeness=min_completeness,
+        core_attributes=core_attributes,
+        inference_config={
             "maxTokens": 4000,
             "temperature": 1
-        }
+        },
+        output_mode=output_mode
     )
 
     # Log token usage
-    if 'usage' in response:
-        usage = response['usage']
-        print(f"Input tokens: {usage.get('inputTokens', 0)}, Output tokens: {usage.get('outputTokens', 0)}")
+    usage = result['usage']
+    print(f"Model: {result['modelId']}, Input tokens: {usage.get('inputTokens', 0)}, Output tokens: {usage.get('outputTokens', 0)}")
 
-    completion = response['output']['message']['content'][0]['text']
+    completion = result['completion']
     print(completion)
 
-    attribution = json.loads(completion)
+    attribution = result['attribution']
+    if len(model_tiers) > 1:
+        record_routing_stats(ddb, routing_stats_table_name, event["data"]["useCase"].lower(), result)
 
-    update_expression = "SET Progress = :p1, CurrentStep = :p2,"
-    expression_values = {":p1": {"N": "100"}, ":p2": {"S": "Attribution Generated"}}
+    update_expression = "SET Progress = :p1, CurrentStep = :p2, AttributionModel = :p3,"
+    expression_values = {":p1": {"N": "100"}, ":p2": {"S": "Attribution Generated"},
+                         ":p3": {"S": result['modelId']}}
     i = 1
     for k, v in attribution.items():
         update_expression += f"{k} = :v{str(i)},"
@@ -107,5 +221,6 @@ def lambda_handler(event, context):
         'completion': completion,
         'id': id,
         'useCase': event["data"]["useCase"],
-        'paths': event["data"]["paths"]
+        'paths': event["data"]["paths"],
+        'selectedPaths': [path for path, _, _ in selected_images]
     }
@@ -0,0 +1,59 @@
+import hashlib
+import json
+
+# Seed range accepted by Nova Canvas
+max_seed = 858993459
+
+
+def content_digest(data):
+    # SHA-256 of an image, as base64 string or bytes
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def derive_seed(*parts, offset=0):
+    """
+    Seed derived from the inputs of a generation, so identical inputs always get the same seed
+
+    Args:
+        parts: JSON serializable inputs, e.g. image digests, garment class and generation config
+        offset: Added to the derived seed for variety, e.g. the image index
+
+    Returns:
+        Seed between 0 and max_seed
+    """
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(",", ":")).encode("utf-8")).digest()
+    return (int.from_bytes(digest[:8], "big") + offset) % (max_seed + 1)
+
+
+def cached_invoke(s3, bucket, prefix, model_id, body_json, invoke):
+    """
+    Nova Canvas response served from S3 when the same request body was generated before
+
+    The key is the SHA-256 of the model id and request body, which contains the input images, the
+    generation config and the seed, so only deterministic seeds lead to cache hits.
+
+    Args:
+        s3: S3 client
+        bucket: Cache bucket
+        prefix: Key prefix of the cached responses
+        model_id: Image generation model id
+        body_json: InvokeModel request body
+        invoke: Function invoking the model and returning the parsed response body
+
+    Returns:
+        Tuple of (response body, cache hit flag)
+    """
+    key = f"{prefix}{content_digest(model_id + chr(10) + body_json)}.json"
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read()), True
+    except s3.exceptions.NoSuchKey:
+        pass
+    except Exception as e:
+        print(f"Error reading cached response {key}: {str(e)}")
+
+    response_body = invoke()
+    if "error" not in response_body:
+        s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(response_body), ContentType="application/json")
+    return response_body, False
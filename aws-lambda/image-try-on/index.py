@@ -1,19 +1,60 @@
 import base64
-import boto3
+import functools
 import io
 import json
 import os
 import random
-import imagesize
+import time
 import concurrent.futures
+import ledger
+from canvas_cache import cached_invoke, content_digest, derive_seed
+from claim_check import is_claim_check, resolve
+from hedging import hedged_call
+from quality import score_try_on
+from startup import lazy_client, lazy_resource, run_at_init
 # Using native Python 3.13 typing features
 
 bucket_name = os.environ["ImageBucketName"]
 image_gen_model_id = os.environ["ModelId"]
-bedrock = boto3.client('bedrock-runtime', region_name=os.environ["AWS_REGION"])
-s3_resource = boto3.resource("s3")
-s3 = boto3.client("s3")
-ddb = boto3.client("dynamodb")
+bedrock = lazy_client('bedrock-runtime', region_name=os.environ["AWS_REGION"])
+s3_resource = lazy_resource("s3")
+s3 = lazy_client("s3")
+ddb = lazy_client("dynamodb")
+
+# Resized variants written next to every try-on output, formats without encoder support are skipped.
+# AVIF is opt-in (DerivativeFormats=webp,avif), its encoding is several times slower than WebP
+derivative_widths = [int(w) for w in os.environ.get("DerivativeWidths", "256,512,1024").split(",") if w]
+
+# Seeds derived from the inputs instead of random ones, identical requests are then served from the cache
+deterministic_seeds = os.environ.get("DeterministicSeeds", "false").lower() == "true"
+canvas_cache_enabled = deterministic_seeds and os.environ.get("CanvasCache", "true").lower() == "true"
+canvas_cache_prefix = "output/cache/"
+
+# Generation settings, part of the derived seeds
+try_on_config = {"maskType": "GARMENT", "maskShape": "BOUNDING_BOX", "cfgScale": 6.5, "numberOfImages": 1}
+model_image_negative_text = "bad quality, low res, cartoon, unreal, head cropped, blur"
+
+# Try-on outputs failing the quality checks are discarded and regenerated up to QualityRetries times,
+# as long as the invocation has QualityRetryMinRemainingMs left
+quality_checks = os.environ.get("QualityChecks", "true").lower() == "true"
+quality_retries = int(os.environ.get("QualityRetries", "1"))
+quality_retry_min_remaining_ms = int(os.environ.get("QualityRetryMinRemainingMs", "45000"))
+
+
+@functools.cache
+def derivative_formats():
+    from PIL import features
+    return [f for f in os.environ.get("DerivativeFormats", "webp").split(",") if f and features.check(f)]
+
+
+def prime():
+    # Import the image libraries at import time in eager startup mode, the clients exist already
+    import imagesize
+    import numpy
+    derivative_formats()
+
+
+run_at_init(prime)
 
 
 def read_as_base64(bucket, key):
@@ -33,6 +74,7 @@ def get_image_dimensions(image_base64):
         Tuple of (width, height)
     """
     try:
+        import imagesize
         # Convert base64 to image bytes
         image_bytes = base64.b64decode(image_base64)
         # Create a BytesIO object from the image bytes
@@ -46,6 +88,72 @@ def get_image_dimensions(image_base64):
         return 1024, 1024
 
 
+def make_derivatives(image_bytes):
+    """
+    Create resized WebP/AVIF variants of an image for the configured widths
+
+    Args:
+        image_bytes: Original image bytes
+
+    Returns:
+        List of (name, bytes, content type) tuples e.g. ("512.webp", b"...", "image/webp")
+    """
+    from PIL import Image
+    derivatives = []
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert("RGB")
+        for width in derivative_widths:
+            if width >= image.width:
+                # Never upscale, the original size is served by the largest variant
+                width = image.width
+            resized = image.resize((width, round(image.height * width / image.width)), Image.Resampling.LANCZOS)
+            for fmt in derivative_formats():
+                buffer = io.BytesIO()
+                resized.save(buffer, format=fmt.upper(), quality=80)
+                derivatives.append((f"{width}.{fmt}", buffer.getvalue(), f"image/{fmt}"))
+            if width == image.width:
+                break
+    return derivatives
+
+
+def compress_mask(mask_bytes):
+    """
+    Convert a mask image to a lossless 1-bit PNG, a fraction of the size of the JPEG mask
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(mask_bytes)) as mask:
+        bilevel = mask.convert("L").point(lambda p: 255 if p >= 128 else 0, mode="1")
+        buffer = io.BytesIO()
+        bilevel.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue()
+
+
+def invoke_canvas(body_json, hedged=False):
+    """
+    Invoke Nova Canvas, served from the cache in deterministic seed mode
+
+    Returns:
+        Tuple of (response body, cache hit flag)
+    """
+    def invoke():
+        response = bedrock.invoke_model(
+            body=body_json,
+            modelId=image_gen_model_id,
+            accept='application/json',
+            contentType='application/json',
+        )
+        return json.loads(response.get('body').read())
+
+    # Duplicate slow requests when hedging is enabled
+    call = (lambda: hedged_call(image_gen_model_id, invoke)) if hedged else invoke
+    if not canvas_cache_enabled:
+        return call(), False
+    response_body, cached = cached_invoke(s3, bucket_name, canvas_cache_prefix, image_gen_model_id, body_json, call)
+    if cached:
+        ledger.add("CanvasCacheHits")
+    return response_body, cached
+
+
 def classify_garment(image_base64, extension):
     """
     Classify the type of garment in an image using Amazon Bedrock Nova Pro model.
@@ -89,7 +197,8 @@ def classify_garment(image_base64, extension):
 def apply_nova_virtual_try_on(
     source_image_base64,
     reference_image_base64,
-    garment_class
+    garment_class,
+    seed_offset=0
 ):
     """
     Apply virtual try-on using Amazon Bedrock's Nova Canvas model.
@@ -98,58 +207,70 @@ def apply_nova_virtual_try_on(
         source_image_base64: Base64 encoded string of the person/model image
         reference_image_base64: Base64 encoded string of the garment image
         garment_class: Type of garment classification
+        seed_offset: Variety offset added to the seed in deterministic seed mode
         
     Returns:
-        Dictionary containing the response with 'images' (list of base64 strings) and 'maskImage' (single base64 string)
+        Dictionary containing the response with 'images' (list of base64 strings) and 'maskImage' (single base64 string),
+        and 'cached' when it was served from the cache
     """
+    if deterministic_seeds:
+        seed = derive_seed(content_digest(source_image_base64), content_digest(reference_image_base64),
+                           garment_class, try_on_config, offset=seed_offset)
+    else:
+        seed = random.randint(0, 100000000)
+
     # Prepare payload for Nova Canvas
     payload = {
         'taskType': 'VIRTUAL_TRY_ON',
         'virtualTryOnParams': {
             'sourceImage': source_image_base64,
             'referenceImage': reference_image_base64,
-            'maskType': 'GARMENT',
+            'maskType': try_on_config["maskType"],
+            # The mask is only returned on request, the quality checks and the stored mask need it
+            'returnMask': True,
             'garmentBasedMask': {
                 'garmentClass': garment_class,
-                "maskShape": "BOUNDING_BOX",
+                "maskShape": try_on_config["maskShape"],
             }
         },
         'imageGenerationConfig': {
-            "numberOfImages": 1,
-            "cfgScale": 6.5,
+            "numberOfImages": try_on_config["numberOfImages"],
+            "cfgScale": try_on_config["cfgScale"],
             # 'quality': 'premium',
-            'seed': random.randint(0, 100000000)
+            'seed': seed
         }
     }
 
     body_json = json.dumps(payload)
 
-    # Use the existing bedrock client
     try:
-        response = bedrock.invoke_model(
-            body=body_json,
-            modelId=image_gen_model_id,
-            accept='application/json',
-            contentType='application/json',
-        )
-        response_body = json.loads(response.get('body').read())
+        response_body, cached = invoke_canvas(body_json, hedged=True)
 
         if 'error' in response_body:
             raise Exception(f"Error in response: {response_body['error']}")
 
         # Return the complete response body containing images and maskImage
-        return response_body
+        return dict(response_body, cached=cached)
     except Exception as e:
         print(f"Error in Nova Canvas virtual try-on: {str(e)}")
         raise
 
+@ledger.recorded("image-try-on", lambda event: (event["id"], event.get("executionId")),
+                 clients=[bedrock, s3, s3_resource])
 def lambda_handler(event, context):
+    # The label summary merged into the execution input is an S3 reference when label detection offloaded it
+    if is_claim_check(event):
+        event = dict(event, **resolve(event))
     pose = event["influenceImagePose"]
     emotion = event["influenceImageEmotion"]
     body_structure = event["influenceImageBodyStructure"]
     num_images = event["influenceImageNumImages"]
     gender = event["influenceGender"]
     id = event["id"]
+    # Rekognition label of the garment, merged into the execution input by the workflow
+    ledger.set_category(event.get("label"))
+    # Changing the offset gives new images for otherwise identical inputs in deterministic seed mode
+    seed_offset = int(event.get("seedOffset", 0))
 
     reference_images = []
     reference_images_prefixes = []
@@ -167,7 +288,7 @@ def lambda_handler(event, context):
     else:
         # 1. Generate model images from the text
         prompt = f"realistic full body length photo of a {gender} fashion model, {body_structure} body structure, {emotion}, wearing a plain white t-shirt, standing in a {pose} front facing pose against a plain background, studio lighting"
-        generated_images = generate_model_image(num_images, prompt, width, height)
+        generated_images = generate_model_image(num_images, prompt, width, height, seed_offset)
         reference_images.extend(generated_images)
 
     # Classify the garment type from the cloth image
@@ -204,72 +325,170 @@ def lambda_handler(event, context):
         }
     )
 
-    # Process a single try-on operation
-    def process_single_try_on(args):
+    # Generate and score a single try-on operation
+    def generate_try_on(args):
         """
-        Process a single virtual try-on operation
-        
+        Generate a single virtual try-on result and score it
+
         Args:
-            args: Tuple containing (source_image_base64, index, cloth_image, garment_type)
-            
+            args: Tuple containing (source_image_base64, index, cloth_image, garment_type, attempt)
+
         Returns:
-            Dictionary with output image key and mask key (if available)
+            Dictionary with the index, image and mask bytes and the failed quality checks, or the error
         """
-        source_image_base64, index, cloth_image, garment_type = args
-        result = {}
-        
+        source_image_base64, index, cloth_image, garment_type, attempt = args
+
         try:
-            # Apply virtual try-on using Nova
+            # Apply virtual try-on using Nova, regenerations use another seed offset than the other indices
             try_on_result = apply_nova_virtual_try_on(
                 source_image_base64=source_image_base64,
                 reference_image_base64=cloth_image,
-                garment_class=garment_type
+                garment_class=garment_type,
+                seed_offset=seed_offset + index + attempt * len(generated_images)
             )
-            
-            # Save result image
+            if try_on_result['cached']:
+                print(f"Try-on result for index {index} served from the cache")
+
             image_bytes = base64.b64decode(try_on_result['images'][0])
-            key = event["path"].replace("input/", "output/").replace(".jpg", "").replace(".png", "") + f"/{index}.jpg"
+            mask_bytes = base64.b64decode(try_on_result['maskImage']) if 'maskImage' in try_on_result else None
+            if mask_bytes is None:
+                # Without a mask only the sharpness check can run and no mask is stored
+                print(f"Warning: try-on result for index {index} has no mask")
+                ledger.add("MissingMasks")
+
+            failed_checks = []
+            if quality_checks:
+                scores, failed_checks = score_try_on(image_bytes, mask_bytes, base64.b64decode(source_image_base64),
+                                                     event.get("boundingBox"), (width, height))
+                print(f"Quality scores for index {index} attempt {attempt}: {json.dumps(scores)}")
+                if failed_checks:
+                    ledger.add("QualityRejected")
+            return {"index": index, "image_bytes": image_bytes, "mask_bytes": mask_bytes,
+                    "failed_checks": failed_checks}
+
+        except Exception as e:
+            print(f"Error in virtual try-on for index {index}: {str(e)}")
+            return {"success": False, "error": str(e), "index": index}
+
+    # Upload a single try-on result
+    def save_try_on(try_on):
+        """
+        Upload a try-on result with its mask and derivatives and record it in the product draft
+
+        Args:
+            try_on: Result of generate_try_on, a result failing the quality checks is also listed in
+                QualityFailedImages
+
+        Returns:
+            Dictionary with output image key and index
+        """
+        index, image_bytes, mask_bytes = try_on["index"], try_on["image_bytes"], try_on["mask_bytes"]
+        quality_failed = bool(try_on["failed_checks"])
+
+        try:
+            # Save result image
+            output_prefix = event["path"].replace("input/", "output/").replace(".jpg", "").replace(".png", "")
+            key = output_prefix + f"/{index}.jpg"
             s3.put_object(Body=image_bytes, Bucket=bucket_name, Key=key)
-            result["output_key"] = key
-            
+
             # Update DynamoDB with this output image immediately
             try:
+                update_expression = "SET OutputImages = list_append(if_not_exists(OutputImages, :empty_list), :new_image)"
+                if quality_failed:
+                    update_expression += ", QualityFailedImages = list_append(if_not_exists(QualityFailedImages, :empty_list), :new_image)"
                 ddb.update_item(
                     TableName=os.environ["TableName"],
                     Key={"Id": {"S": event["id"]}},
-                    UpdateExpression="SET OutputImages = list_append(if_not_exists(OutputImages, :empty_list), :new_image)",
+                    UpdateExpression=update_expression,
                     ExpressionAttributeValues={
                         ":new_image": {"L": [{"S": key}]},
                         ":empty_list": {"L": []}
                     }
                 )
-                print(f"Updated DynamoDB with new output image: {key}")
+                print(f"Updated DynamoDB with new output image: {key}" + (" (quality failed)" if quality_failed else ""))
             except Exception as e:
                 print(f"Error updating DynamoDB with output image: {str(e)}")
-            
-            # Save mask image if available
-            if 'maskImage' in try_on_result:
-                mask_image_bytes = base64.b64decode(try_on_result['maskImage'])
-                mask_key = event["path"].replace("input/", "output/").replace(".jpg", "").replace(".png", "") + f"/{index}_mask.jpg"
-                s3.put_object(Body=mask_image_bytes, Bucket=bucket_name, Key=mask_key)
-                result["mask_key"] = mask_key
-                
-            return {"success": True, "output_key": key, "index": index}
-                
+
+            # Save mask image if available, as a lossless 1-bit PNG
+            if mask_bytes is not None:
+                mask_image_bytes = compress_mask(mask_bytes)
+                mask_key = output_prefix + f"/{index}_mask.png"
+                s3.put_object(Body=mask_image_bytes, Bucket=bucket_name, Key=mask_key, ContentType="image/png")
+
+            # Save resized variants after the original is recorded, consumers use the original until they exist
+            try:
+                derivatives = {}
+                for name, derivative_bytes, content_type in make_derivatives(image_bytes):
+                    derivative_key = output_prefix + f"/{index}_{name}"
+                    s3.put_object(Body=derivative_bytes, Bucket=bucket_name, Key=derivative_key,
+                                  ContentType=content_type)
+                    derivatives[name] = {"S": derivative_key}
+                ddb.update_item(
+                    TableName=os.environ["TableName"],
+                    Key={"Id": {"S": event["id"]}},
+                    UpdateExpression="SET OutputDerivatives = list_append(if_not_exists(OutputDerivatives, :empty_list), :new_derivatives)",
+                    ExpressionAttributeValues={
+                        ":new_derivatives": {"L": [{"M": {"Image": {"S": key}, "Variants": {"M": derivatives}}}]},
+                        ":empty_list": {"L": []}
+                    }
+                )
+            except Exception as e:
+                print(f"Error creating derivatives for index {index}: {str(e)}")
+
+            return {"success": True, "output_key": key, "index": index, "quality_failed": quality_failed}
+
         except Exception as e:
-            print(f"Error in virtual try-on for index {index}: {str(e)}")
+            print(f"Error saving virtual try-on for index {index}: {str(e)}")
             return {"success": False, "error": str(e), "index": index}
-    
+
     # Apply Nova virtual try-on in parallel for all generated human models
     try_on_tasks = []
     for i, source_image_base64 in enumerate(generated_images):
-        try_on_tasks.append((source_image_base64, i + 1, cloth_image, garment_type))
-    
+        try_on_tasks.append((source_image_base64, i + 1, cloth_image, garment_type, 0))
+
     # Use ThreadPoolExecutor to process try-on operations in parallel
     # Adjust max_workers based on Lambda's capabilities and API rate limits
+    results = {}
+    # Attempt failing the fewest quality checks per index, uploaded flagged when no regeneration passes
+    best = {}
+    quality_rejected = 0
     with concurrent.futures.ThreadPoolExecutor(max_workers=min(10, len(generated_images))) as executor:
-        results = list(executor.map(process_single_try_on, try_on_tasks))
-    
+        for attempt in range(quality_retries + 1):
+            saves = []
+            for future in concurrent.futures.as_completed([executor.submit(generate_try_on, task)
+                                                           for task in try_on_tasks]):
+                try_on = future.result()
+                index = try_on["index"]
+                if "error" in try_on:
+                    results.setdefault(index, try_on)
+                elif not try_on["failed_checks"]:
+                    # Passing results are uploaded as soon as they are scored, not after the whole round
+                    best.pop(index, None)
+                    saves.append(executor.submit(save_try_on, try_on))
+                else:
+                    quality_rejected += 1
+                    if index not in best or len(try_on["failed_checks"]) < len(best[index]["failed_checks"]):
+                        best[index] = try_on
+            for future in saves:
+                result = future.result()
+                results[result["index"]] = result
+
+            # Only the indices that failed the quality checks are regenerated
+            try_on_tasks = [(source, index, cloth, garment, attempt + 1)
+                            for source, index, cloth, garment, _ in try_on_tasks if index in best]
+            if not try_on_tasks or attempt == quality_retries:
+                break
+            if context is not None and context.get_remaining_time_in_millis() < quality_retry_min_remaining_ms:
+                print(f"Not enough time left to regenerate {len(try_on_tasks)} try-on result(s)")
+                break
+            print(f"Regenerating try-on result(s) {[task[1] for task in try_on_tasks]}")
+
+        if best:
+            print(f"Uploading the best attempt of try-on result(s) {sorted(best)} flagged as quality failed")
+        for result in executor.map(save_try_on, best.values()):
+            results[result["index"]] = result
+    results = list(results.values())
+
     # Process results to check for any failures
     failed_results = [result for result in results if not result.get("success", False)]
     if failed_results:
@@ -280,32 +499,38 @@ def lambda_handler(event, context):
     ddb.update_item(
         TableName=os.environ["TableName"],
         Key={"Id": {"S": event["id"]}},
-        UpdateExpression="SET Progress = :v1, CurrentStep = :v2",
+        UpdateExpression="SET Progress = :v1, CurrentStep = :v2, ImagesGeneratedAt = :v3, QualityRejected = :v4",
         ExpressionAttributeValues={
             ":v1": {"N": "100"},
-            ":v2": {"S": "Images Generated"}
+            ":v2": {"S": "Images Generated"},
+            ":v3": {"N": str(time.time())},
+            ":v4": {"N": str(quality_rejected)}
         }
     )
 
 
 
-def generate_model_image(num_images, prompt, width=1024, height=1024):
+def generate_model_image(num_images, prompt, width=1024, height=1024, seed_offset=0):
+    if deterministic_seeds:
+        seed = derive_seed(prompt, model_image_negative_text, num_images, width, height, offset=seed_offset)
+    else:
+        seed = random.randint(0, 100000000)
+
     body = json.dumps({
         "taskType": "TEXT_IMAGE",
         "textToImageParams": {
             "text": prompt,
-            "negativeText": "bad quality, low res, cartoon, unreal, head cropped, blur"
+            "negativeText": model_image_negative_text
         },
         "imageGenerationConfig": {
             "numberOfImages": num_images,
             "height": height,
             "width": width,
-            "seed": random.randint(0, 100000000)
+            "seed": seed
         }
     })
 
-    response = bedrock.invoke_model(
-        body=body, modelId=image_gen_model_id, accept="application/json", contentType="application/json"
-    )
-    response_body = json.loads(response.get("body").read())
+    response_body, cached = invoke_canvas(body)
+    if cached:
+        print("Model images served from the cache")
     return response_body.get("images")
@@ -0,0 +1,106 @@
+import io
+import os
+
+# Thresholds of the try-on quality checks, a check is skipped when its inputs are missing
+min_mask_coverage = float(os.environ.get("MinMaskCoverage", "0.02"))
+max_mask_coverage = float(os.environ.get("MaxMaskCoverage", "0.9"))
+min_box_agreement = float(os.environ.get("MinBoxAgreement", "0.4"))
+max_bleed = float(os.environ.get("MaxBleed", "0.2"))
+min_sharpness_ratio = float(os.environ.get("MinSharpnessRatio", "0.3"))
+
+# Images are scored at reduced resolution, which is faster and tolerates small misalignments at mask edges
+score_edge = 512
+# Gray level difference counted as a change outside of the mask
+bleed_delta = 40
+
+
+def decode(image_bytes, mode, size=None):
+    """
+    Decode an image into a NumPy array, downscaled to score_edge or resized to size (width, height)
+    """
+    import numpy as np
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert(mode)
+        if size is None:
+            scale = min(1.0, score_edge / max(image.size))
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        if image.size != size:
+            # reducing_gap downsamples in integer steps first, much cheaper for large outputs
+            image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return np.asarray(image, dtype=np.float32)
+
+
+def mask_box(mask):
+    # Bounding box (left, top, right, bottom) of the mask pixels, None for an empty mask
+    import numpy as np
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return None
+    return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+
+def sharpness(gray):
+    # Variance of the 4-neighbour Laplacian
+    laplacian = (gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1] - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def score_try_on(image_bytes, mask_bytes, source_bytes, bounding_box=None, garment_size=None):
+    """
+    Score a virtual try-on result against its mask and source image
+
+    Checks the mask coverage, the aspect ratio agreement of the mask box with the Rekognition bounding box
+    of the garment, the share of pixels changed outside of the mask (bleeding) and the sharpness relative
+    to the source image.
+
+    Args:
+        image_bytes: Try-on output image
+        mask_bytes: Mask image returned with the output, black pixels are the garment area
+        source_bytes: Human model image the garment was applied to
+        bounding_box: Rekognition BoundingBox of the garment in the garment image
+        garment_size: Tuple of (width, height) of the garment image
+
+    Returns:
+        Tuple of (scores dictionary, list of failed check names)
+    """
+    import numpy as np
+    output = decode(image_bytes, "L")
+    height, width = output.shape
+    # Decoded once for the bleed and sharpness checks
+    source = decode(source_bytes, "L", (width, height)) if source_bytes is not None else None
+    scores, failed = {}, []
+
+    if mask_bytes is not None:
+        mask = decode(mask_bytes, "L", (width, height)) < 128
+        coverage = float(mask.mean())
+        scores["coverage"] = coverage
+        if not min_mask_coverage <= coverage <= max_mask_coverage:
+            failed.append("coverage")
+
+        box = mask_box(mask)
+        if box is not None and bounding_box and garment_size:
+            mask_aspect = (box[2] - box[0]) / (box[3] - box[1])
+            garment_aspect = (bounding_box["Width"] * garment_size[0]) / (bounding_box["Height"] * garment_size[1])
+            agreement = min(mask_aspect, garment_aspect) / max(mask_aspect, garment_aspect)
+            scores["boxAgreement"] = float(agreement)
+            if agreement < min_box_agreement:
+                failed.append("boxAgreement")
+
+        if source is not None and not mask.all():
+            changed = np.abs(output - source) > bleed_delta
+            bleed = float(changed[~mask].mean())
+            scores["bleed"] = bleed
+            if bleed > max_bleed:
+                failed.append("bleed")
+
+    if source is not None:
+        source_sharpness = sharpness(source)
+        if source_sharpness > 0:
+            ratio = sharpness(output) / source_sharpness
+            scores["sharpnessRatio"] = ratio
+            if ratio < min_sharpness_ratio:
+                failed.append("sharpness")
+
+    return scores, failed
@@ -0,0 +1,29 @@
+import json
+import os
+
+import ledger
+from claim_check import offload
+from labels import detect_labels_cached
+from startup import lazy_client
+
+rekognition = lazy_client('rekognition')
+s3 = lazy_client('s3')
+ddb = lazy_client('dynamodb')
+
+bucket_name = os.environ["ImageBucketName"]
+cache_table_name = os.environ["LabelCacheTableName"]
+# Lifetime of cached label detection results, 0 always calls Rekognition
+cache_ttl_seconds = int(os.environ.get("LabelCacheTtlSeconds", "604800"))
+
+
+@ledger.recorded("label-detection", lambda event: (event["id"], event.get("executionId")), clients=[rekognition, s3])
+def lambda_handler(event, context):
+    print(json.dumps(event))
+    summary, cache_hit = detect_labels_cached(rekognition, s3, ddb, cache_table_name, bucket_name, event["path"],
+                                              cache_ttl_seconds)
+    ledger.set_category(summary["label"])
+    if cache_hit:
+        ledger.add("LabelCacheHits")
+    print(f"Label detection cache {'hit' if cache_hit else 'miss'} for {event['path']}: {json.dumps(summary)}")
+    # Passed on to the attribution and image generation branches, as an S3 reference when offloading is enabled
+    return offload(summary, bucket_name, f"state/{event['id']}/labels.json")
@@ -0,0 +1,204 @@
+import json
+import os
+import time
+
+from startup import lazy_client
+from structured_output import converse_structured
+
+bedrock = lazy_client(service_name='bedrock-runtime', region_name=os.environ['AWS_REGION'])
+ddb = lazy_client('dynamodb')
+
+table_name = os.environ["TableName"]
+phrase_table_name = os.environ["PhraseTableName"]
+model_id = os.environ["ModelId"]
+output_mode = os.environ.get("OutputMode", "text")
+# Locales used when the event has none, empty disables the localization in the catalog workflow
+default_locales = [l for l in os.environ.get("Locales", "").split(",") if l]
+localized_attributes = os.environ.get(
+    "LocalizedAttributes",
+    "Title,Description,Fabric,Pattern,Print,PrintedTextColors,PrintPlacement,SpecialFeatures,Cut,Fit,Occasion,"
+    "Texture,Weight,CollarType,Weather,ProductLength,Color,Waistline,Hemline,Neckline,Sleeves,SleeveStyle,"
+    "Transparency,SuggestedPriceReason,GenderAffinity,WashingInstructions,SustainabilityFeatures").split(",")
+# Values up to this length are looked up in and added to the phrase dictionary
+phrase_max_chars = int(os.environ.get("PhraseMaxChars", "40"))
+# Source characters times locales translated in one model call
+batch_chars = int(os.environ.get("TranslationBatchChars", "12000"))
+
+translation_prompt = """Translate each of the product catalog texts in the JSON object below into these locales: {locales}
+- Keep brand names, sizes, numbers and units unchanged
+- Use the usual retail terminology of each locale
+- Return only a JSON object with the key <text id>_<locale> for every text and locale, e.g. t1_{example}
+
+{texts}"""
+
+
+def chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def backoff(attempt):
+    # Exponential backoff before retrying unprocessed keys or items of a throttled table
+    if attempt:
+        time.sleep(min(0.05 * 2 ** attempt, 2))
+
+
+def batch_get(table, keys, projection=None):
+    # BatchGetItem in chunks of 100 keys, retrying unprocessed keys
+    items = []
+    for chunk in chunks(keys, 100):
+        request = {table: {"Keys": chunk}}
+        if projection:
+            request[table]["ProjectionExpression"] = projection["expression"]
+            request[table]["ExpressionAttributeNames"] = projection["names"]
+        attempt = 0
+        while request:
+            backoff(attempt)
+            response = ddb.batch_get_item(RequestItems=request)
+            items.extend(response["Responses"].get(table, []))
+            request = response.get("UnprocessedKeys")
+            attempt += 1
+    return items
+
+
+def lookup_phrases(values, locales):
+    """
+    Cached translations of short values
+
+    Returns:
+        Dictionary of (value, locale) to translation
+    """
+    keys = [{"Phrase": {"S": f"{locale}#{value}"}} for value in values for locale in locales]
+    phrases = {}
+    for item in batch_get(phrase_table_name, keys):
+        locale, _, value = item["Phrase"]["S"].partition("#")
+        phrases[(value, locale)] = item["Translation"]["S"]
+    return phrases
+
+
+def store_phrases(translations):
+    # Add new translations of short values to the phrase dictionary
+    requests = [{"PutRequest": {"Item": {
+        "Phrase": {"S": f"{locale}#{value}"},
+        "Translation": {"S": translation},
+        "ModelId": {"S": model_id},
+        "CreatedAt": {"N": str(time.time())}
+    }}} for (value, locale), translation in translations.items()]
+    for chunk in chunks(requests, 25):
+        request = {phrase_table_name: chunk}
+        attempt = 0
+        while request:
+            backoff(attempt)
+            request = ddb.batch_write_item(RequestItems=request).get("UnprocessedItems")
+            attempt += 1
+
+
+def translate(texts, locales):
+    """
+    Translate unique texts into all locales with a single text-only model call
+
+    Returns:
+        Tuple of (dictionary of (text, locale) to translation, usage)
+    """
+    ids = {f"t{i + 1}": text for i, text in enumerate(texts)}
+    schema = {f"{tid}_{locale}": "string" for tid in ids for locale in locales}
+    prompt = translation_prompt.format(locales=", ".join(locales), example=locales[0],
+                                       texts=json.dumps(ids, ensure_ascii=False, indent=1))
+    messages = [{"role": "user", "content": [{"text": prompt}]}]
+    _, translated, usage = converse_structured(bedrock, model_id, messages, schema,
+                                               {"maxTokens": 10000, "temperature": 0}, output_mode)
+
+    translations = {}
+    for tid, text in ids.items():
+        for locale in locales:
+            value = translated.get(f"{tid}_{locale}")
+            if isinstance(value, str) and value:
+                translations[(text, locale)] = value
+    return translations, usage
+
+
+def translation_batches(texts, locales):
+    # Group texts so that each model call stays within the character budget
+    batch, size = [], 0
+    for text in texts:
+        cost = len(text) * len(locales)
+        if batch and size + cost > batch_chars:
+            yield batch
+            batch, size = [], 0
+        batch.append(text)
+        size += cost
+    if batch:
+        yield batch
+
+
+def save_localization(id, values, locales):
+    # Locale-suffixed copies of the attributes, e.g. Title_fr-FR
+    names = {"#l": "Locales", "#t": "LocalizedAt"}
+    expression_values = {":l": {"S": ",".join(locales)}, ":t": {"N": str(time.time())}}
+    update_expression = "SET #l = :l, #t = :t,"
+    for i, ((attribute, locale), value) in enumerate(values.items()):
+        names[f"#a{i}"] = f"{attribute}_{locale}"
+        expression_values[f":v{i}"] = {"S": value}
+        update_expression += f"#a{i} = :v{i},"
+
+    ddb.update_item(
+        TableName=table_name,
+        Key={"Id": {"S": id}},
+        UpdateExpression=update_expression[:-1],
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=expression_values
+    )
+
+
+def lambda_handler(event, context):
+    """
+    Translate the attribution of product drafts into locales
+
+    Args:
+        event: {"ids": [...], "locales": [...]}, locales default to the Locales environment variable
+    """
+    print(json.dumps(event))
+    locales = event.get("locales") or default_locales
+    if not locales:
+        return {"localized": 0, "locales": []}
+
+    projection = {"names": {f"#a{i}": a for i, a in enumerate(localized_attributes)} | {"#id": "Id"}}
+    projection["expression"] = ",".join(projection["names"])
+    drafts = batch_get(table_name, [{"Id": {"S": id}} for id in dict.fromkeys(event["ids"])], projection)
+
+    sources = {}
+    for draft in drafts:
+        sources[draft["Id"]["S"]] = {a: draft[a]["S"] for a in localized_attributes
+                                     if a in draft and "S" in draft[a] and draft[a]["S"].strip()}
+
+    # Short values like Fabric or Occasion repeat across products and are translated once
+    values = {v for attributes in sources.values() for v in attributes.values()}
+    phrases = sorted(v for v in values if len(v) <= phrase_max_chars)
+    translations = lookup_phrases(phrases, locales) if phrases else {}
+    print(f"Phrase dictionary hits: {len(translations)} of {len(phrases) * len(locales)}")
+
+    pending = sorted(v for v in values if any((v, locale) not in translations for locale in locales))
+    usage = {}
+    for batch in translation_batches(pending, locales):
+        try:
+            translated, batch_usage = translate(batch, locales)
+        except Exception as e:
+            print(f"Error translating batch of {len(batch)} texts: {str(e)}")
+            continue
+        for k, v in batch_usage.items():
+            usage[k] = usage.get(k, 0) + v
+        # Cached phrases are kept, the other locales of a partially cached value are new
+        translated = {k: v for k, v in translated.items() if k not in translations}
+        store_phrases({k: v for k, v in translated.items() if len(k[0]) <= phrase_max_chars})
+        translations.update(translated)
+
+    localized = 0
+    for id, attributes in sources.items():
+        localized_values = {(a, locale): translations[(v, locale)] for a, v in attributes.items()
+                            for locale in locales if (v, locale) in translations}
+        if localized_values:
+            save_localization(id, localized_values, locales)
+            localized += 1
+
+    print(f"Localized {localized} of {len(event['ids'])} drafts into {locales}, usage: {json.dumps(usage)}")
+    return {"localized": localized, "locales": locales, "usage": usage}
@@ -1,20 +1,41 @@
 import base64
 import json
 import os
+import time
 
-import boto3
+import claim_check
+import ledger
+from claim_check import resolve
+from labels import summarize_labels
+from model_routing import converse_with_routing, record_routing_stats
+from startup import lazy_client, lazy_resource, load_template, run_at_init
 
-bedrock = boto3.client(service_name='bedrock-runtime',
-                       region_name=os.environ['AWS_REGION'])
-s3 = boto3.resource('s3')
-ddb = boto3.client('dynamodb')
+bedrock = lazy_client(service_name='bedrock-runtime',
+                      region_name=os.environ['AWS_REGION'])
+s3 = lazy_resource('s3')
+ddb = lazy_client('dynamodb')
 
 model_id = os.environ["ModelId"]
+# Optional cheaper model tried first, escalating to ModelId for invalid or sparse attributions
+fast_model_id = os.environ.get("FastModelId", "")
+min_completeness = float(os.environ.get("MinCompleteness", "0.6"))
+# Attributes every garment has, attributes that don't apply are left empty and not scored
+core_attributes = os.environ.get(
+    "CoreAttributes",
+    "Title,Description,Color,Fabric,Fit,Occasion,GenderAffinity,SuggestedPrice,SuggestedPriceReason,"
+    "ImageGeneratorPrompt").split(",")
+routing_stats_table_name = os.environ.get("RoutingStatsTableName", "")
+# "tool" constrains the output with Converse tool use, "text" parses and repairs the free text completion
+output_mode = os.environ.get("OutputMode", "text")
 bucket_name = os.environ["ImageBucketName"]
 
-with open('clothing-template.txt', 'r') as file:
-    clothing_prompt = file.read()
-    file.close()
+
+def prime():
+    # Load the template at import time in eager startup mode, the clients exist already
+    load_template('clothing')
+
+
+run_at_init(prime)
 
 
 def read_as_base64(bucket, key):
@@ -23,60 +44,25 @@ def read_as_base64(bucket, key):
     return base64.b64encode(obj['Body'].read()).decode('utf-8')
 
 
+@ledger.recorded("product-attribution", lambda event: (event["data"]["id"], event["executionId"]),
+                 clients=[bedrock, s3, claim_check.s3])
 def lambda_handler(event, context):
     print(json.dumps(event))
 
     id = event["data"]["id"]
-    labels = event["data"]["rekognition"]["Labels"]
-    tags = []
-    category_tags = []
-    for label in labels:
-        if "Instances" in label and len(label["Instances"]) > 0:
-            detected_label = label
-        else:
-            tags.append(label["Name"])
-            tags.extend([c["Name"] for c in label["Aliases"]])
-            category_tags.extend([c["Name"] for c in label["Categories"]])
-            if "Parents" in label:
-                for p in label["Parents"]:
-                    category_tags.append(p["Name"])
-
-    print(f"detected label: {detected_label}")
-    categories = [c["Name"] for c in detected_label["Categories"]]
-    categories.append(detected_label["Name"])
-
-    bounding_box = detected_label["Instances"][0]["BoundingBox"]
-    color_palette = [c["HexCode"] for c in detected_label["Instances"][0]["DominantColors"]]
-    if "Parents" in detected_label:
-        for p in detected_label["Parents"]:
-            categories.insert(0, p["Name"])
-
-    print(f"detected categories 3: {categories}")
-    final_prompt = fill_template(clothing_prompt, detected_label, event["data"])
+    # Precomputed by the label detection step, older inputs carry the raw Rekognition response
+    if "labels" in event["data"]:
+        summary = resolve(event["data"]["labels"])
+    else:
+        summary = summarize_labels(resolve(event["data"]["rekognition"])["Labels"])
+    print(f"detected label: {json.dumps(summary)}")
+    ledger.set_category(summary["label"])
 
-    ddb.put_item(
-        TableName=os.environ["TableName"],
-        Item={
-            'Id': {'S': id},
-            'ImageBucket': {'S': bucket_name},
-            'InputPath': {'S': event["data"]["path"]},
-            'ExecutionId': {'S': event["executionId"]},
-            'ParentCategories': {'S': " > ".join(categories)},
-            'RootCategory': {'S': detected_label["Name"]},
-            'BoundingBox': {'M': {
-                'width': {'N': str(bounding_box["Width"])},
-                'height': {'N': str(bounding_box["Height"])},
-                'left': {'N': str(bounding_box["Left"])},
-                'top': {'N': str(bounding_box["Top"])}
-            }},
-            'ColorPalette': {'S': ",".join(color_palette)},
-            'CategoryTags': {'S': ",".join(set(category_tags))},
-            'AliasTags': {'S': ",".join(set(tags))},
-            'AttributionPrompt': {'S': final_prompt},
-            'Progress': {'N': '33'},
-            'CurrentStep': {'S': 'Label and categories generated'}
-        }
-    )
+    clothing_prompt, clothing_schema = load_template('clothing')
+    final_prompt = fill_template(clothing_prompt, summary["label"], event["data"])
+
+    save_draft(id, event["data"]["path"], event["executionId"], summary, final_prompt,
+               'Label and categories generated')
 
     # Prepare the content for Converse API
     extension = event["data"]["path"].split(".")[-1]
@@ -96,33 +82,89 @@ def lambda_handler(event, context):
         }
     ]
 
-    # Make the API call using Converse API
-    response = bedrock.converse(
-        modelId=model_id,
+    # Make the API call using Converse API, trying the fast model first when configured
+    model_tiers = [fast_model_id, model_id] if fast_model_id and fast_model_id != model_id else [model_id]
+    result = converse_with_routing(
+        bedrock,
+        model_tiers,
         messages=[
             {
                 "role": "user",
                 "content": content
             }
         ],
-        inferenceConfig={
+        schema=clothing_schema,
+        min_completeness=min_completeness,
+        core_attributes=core_attributes,
+        inference_config={
             "maxTokens": 4000,
             "temperature": 1
-        }
+        },
+        output_mode=output_mode
     )
 
     # Log token usage
-    if 'usage' in response:
-        usage = response['usage']
-        print(f"Input tokens: {usage.get('inputTokens', 0)}, Output tokens: {usage.get('outputTokens', 0)}")
+    usage = result['usage']
+    print(f"Model: {result['modelId']}, Input tokens: {usage.get('inputTokens', 0)}, Output tokens: {usage.get('outputTokens', 0)}")
 
-    completion = response['output']['message']['content'][0]['text']
+    completion = result['completion']
     print(completion)
 
-    attribution = json.loads(completion)
+    attribution = result['attribution']
+    if len(model_tiers) > 1:
+        record_routing_stats(ddb, routing_stats_table_name, summary["label"], result)
+
+    save_attribution(id, attribution, result['modelId'])
+
+    return {
+        'completion': completion,
+        'detectedLabel': summary,
+        'path': event["data"]["path"],
+        'categoryTags': ",".join(summary["categoryTags"]),
+        'aliasTags': ",".join(summary["aliasTags"]),
+        'colorPalette': summary["colorPalette"],
+        'id': id,
+        'influenceImageNumImages': event["data"]["influenceImageNumImages"],
+        'influenceImagePose': event["data"]["influenceImagePose"],
+        'influenceImageEmotion': event["data"]["influenceImageEmotion"],
+        'influenceImageBodyStructure': event["data"]["influenceImageBodyStructure"]
+    }
+
+
+def save_draft(id, path, execution_id, summary, final_prompt, current_step):
+    # Create the product draft with the label detection results and the attribution prompt
+    bounding_box = summary["boundingBox"]
+    ddb.put_item(
+        TableName=os.environ["TableName"],
+        Item={
+            'Id': {'S': id},
+            'ImageBucket': {'S': bucket_name},
+            'InputPath': {'S': path},
+            'ExecutionId': {'S': execution_id},
+            'ParentCategories': {'S': " > ".join(summary["categories"])},
+            'RootCategory': {'S': summary["label"]},
+            'BoundingBox': {'M': {
+                'width': {'N': str(bounding_box["Width"])},
+                'height': {'N': str(bounding_box["Height"])},
+                'left': {'N': str(bounding_box["Left"])},
+                'top': {'N': str(bounding_box["Top"])}
+            }},
+            'ColorPalette': {'S': ",".join(summary["colorPalette"])},
+            'CategoryTags': {'S': ",".join(summary["categoryTags"])},
+            'AliasTags': {'S': ",".join(summary["aliasTags"])},
+            'AttributionPrompt': {'S': final_prompt},
+            'StartedAt': {'N': str(time.time())},
+            'Progress': {'N': '33'},
+            'CurrentStep': {'S': current_step}
+        }
+    )
+
 
-    update_expression = "SET Progress = :p1, CurrentStep = :p2,"
-    expression_values = {":p1": {"N": "66"}, ":p2": {"S": "Product Attribution Generated"}}
+def save_attribution(id, attribution, attribution_model_id):
+    # Store every generated attribute as a string attribute of the product draft
+    update_expression = "SET Progress = :p1, CurrentStep = :p2, AttributionModel = :p3, AttributedAt = :p4,"
+    expression_values = {":p1": {"N": "66"}, ":p2": {"S": "Product Attribution Generated"},
+                         ":p3": {"S": attribution_model_id}, ":p4": {"N": str(time.time())}}
     i = 1
     for k, v in attribution.items():
         update_expression += f"{k} = :v{str(i)},"
@@ -136,27 +178,13 @@ def lambda_handler(event, context):
         ExpressionAttributeValues=expression_values
     )
 
-    return {
-        'completion': completion,
-        'detectedLabel': detected_label,
-        'path': event["data"]["path"],
-        'categoryTags': ",".join(set(category_tags)),
-        'aliasTags': ",".join(set(tags)),
-        'colorPalette': color_palette,
-        'id': id,
-        'influenceImageNumImages': event["data"]["influenceImageNumImages"],
-        'influenceImagePose': event["data"]["influenceImagePose"],
-        'influenceImageEmotion': event["data"]["influenceImageEmotion"],
-        'influenceImageBodyStructure': event["data"]["influenceImageBodyStructure"]
-    }
-
 
-def fill_template(template, detected_label, event_data):
+def fill_template(template, label, event_data):
     promoted = "No"
     if event_data["isPromoted"]:
         promoted = "Yes"
 
-    return (template.replace('{label}', detected_label["Name"])
+    return (template.replace('{label}', label)
             .replace('{brand-voice}', event_data["influenceBrandVoice"])
             .replace('{usp}', event_data["influenceBrandStrength"])
             .replace('{influence-price}', event_data["influencePrice"])
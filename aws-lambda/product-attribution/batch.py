@@ -0,0 +1,200 @@
+import concurrent.futures
+import json
+import os
+
+from app import bucket_name, fill_template, model_id, save_attribution, save_draft
+from labels import detect_labels_cached
+from local_batch import LocalBatchClient
+from startup import lazy_client, load_template
+from structured_output import repair_json
+
+s3 = lazy_client('s3')
+ddb = lazy_client('dynamodb')
+rekognition = lazy_client('rekognition')
+bedrock_runtime = lazy_client(service_name='bedrock-runtime', region_name=os.environ['AWS_REGION'])
+
+# "bedrock" submits Bedrock batch inference jobs, "local" runs the records synchronously for testing
+batch_backend = os.environ.get("BatchBackend", "bedrock")
+batch_role_arn = os.environ.get("BatchRoleArn", "")
+label_cache_table_name = os.environ.get("LabelCacheTableName", "")
+label_cache_ttl_seconds = int(os.environ.get("LabelCacheTtlSeconds", "604800"))
+# Manifest lines per prepare invocation and input file, below the records per input file quota
+chunk_size = int(os.environ.get("BatchChunkSize", "1000"))
+# Records per batch inference job, larger manifests are split into several jobs
+records_per_job = int(os.environ.get("BatchRecordsPerJob", "50000"))
+# Minimum records per batch inference job accepted by Bedrock
+min_records_per_job = int(os.environ.get("BatchMinRecordsPerJob", "100"))
+max_workers = 16
+
+
+def batch_client():
+    if batch_backend == "local":
+        return LocalBatchClient(bedrock_runtime, s3)
+    return lazy_client('bedrock')
+
+
+def model_input(path, final_prompt):
+    # InvokeModel request body of a Nova model, the image is read by Bedrock from S3
+    extension = path.split(".")[-1].lower()
+    if extension == "jpg":
+        extension = "jpeg"
+    return {
+        "schemaVersion": "messages-v1",
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"image": {"format": extension, "source": {"s3Location": {"uri": f"s3://{bucket_name}/{path}"}}}},
+                {"text": final_prompt}
+            ]
+        }],
+        "inferenceConfig": {"maxTokens": 4000, "temperature": 1}
+    }
+
+
+def prepare_record(data, job_name):
+    # Label detection and prompt rendering of a single item, as in the online attribution
+    summary, _ = detect_labels_cached(rekognition, s3, ddb, label_cache_table_name, bucket_name, data["path"],
+                                      label_cache_ttl_seconds)
+    clothing_prompt, _ = load_template('clothing')
+    final_prompt = fill_template(clothing_prompt, summary["label"], data)
+    save_draft(data["id"], data["path"], job_name, summary, final_prompt, 'Queued for batch attribution')
+    return {"recordId": data["id"], "modelInput": model_input(data["path"], final_prompt)}
+
+
+def plan(job):
+    """
+    Split a manifest of catalog workflow inputs, one JSON per line, into batch inference jobs of input chunks
+
+    The lines are spread evenly over the fewest jobs of at most BatchRecordsPerJob records, so no job is left
+    with a small remainder. Only the byte ranges of the chunks are recorded, the prepare invocations read
+    their lines themselves.
+
+    Returns:
+        The job with parts, one per batch inference job, each with its chunks
+
+    Raises:
+        ValueError: If a job would have fewer than BatchMinRecordsPerJob records
+    """
+    job_name = job["jobName"]
+    size = int(job.get("chunkSize", chunk_size))
+    manifest = s3.get_object(Bucket=bucket_name, Key=job["manifest"])["Body"]
+
+    # Start offsets of the non-empty lines, blank lines are read along with the preceding line
+    starts = []
+    offset = 0
+    for line in manifest.iter_lines(keepends=True):
+        if line.strip():
+            starts.append(offset)
+        offset += len(line)
+    starts.append(offset)
+    lines = len(starts) - 1
+
+    jobs = max(1, -(-lines // records_per_job))
+    if lines // jobs < min_records_per_job:
+        raise ValueError(f"Manifest of {lines} lines gives batch inference jobs of {lines // jobs} records, "
+                         f"below the minimum of {min_records_per_job}")
+
+    parts = []
+    first = number = 0
+    for p in range(jobs):
+        count = lines // jobs + (p < lines % jobs)
+        part_name = f"{job_name}-{p + 1}"
+        chunks = []
+        for c in range(first, first + count, size):
+            last = min(c + size, first + count)
+            chunks.append({"chunk": number, "range": f"bytes={starts[c]}-{starts[last] - 1}", "lines": last - c})
+            number += 1
+        parts.append({
+            "jobName": part_name,
+            "manifest": job["manifest"],
+            "chunks": chunks,
+            "inputUri": f"s3://{bucket_name}/batch/{part_name}/input/",
+            "outputUri": f"s3://{bucket_name}/batch/{part_name}/output/"
+        })
+        first += count
+    return dict(job, parts=parts, lines=lines)
+
+
+def prepare(job):
+    """
+    Render the batch inference input file of one manifest chunk, the chunk and range of plan
+    """
+    job_name = job["jobName"]
+    manifest = s3.get_object(Bucket=bucket_name, Key=job["manifest"], Range=job["range"])["Body"]
+    items = [json.loads(line) for line in manifest.iter_lines() if line.strip()]
+
+    records = []
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(prepare_record, data, job_name) for data in items]
+        for future in futures:
+            try:
+                records.append(future.result())
+            except Exception as e:
+                print(f"Error preparing batch record: {str(e)}")
+                failed += 1
+
+    if records:
+        input_key = f"batch/{job_name}/input/records-{job['chunk']:05d}.jsonl"
+        s3.put_object(Bucket=bucket_name, Key=input_key, Body="\n".join(json.dumps(r) for r in records))
+    return {"chunk": job["chunk"], "records": len(records), "prepareFailed": failed}
+
+
+def submit(job):
+    response = batch_client().create_model_invocation_job(
+        jobName=job["jobName"],
+        roleArn=batch_role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": job["inputUri"], "s3InputFormat": "JSONL"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": job["outputUri"]}}
+    )
+    return dict(job, jobArn=response["jobArn"])
+
+
+def status(job):
+    response = batch_client().get_model_invocation_job(jobIdentifier=job["jobArn"])
+    return dict(job, status=response["status"])
+
+
+def collect_record(line):
+    record = json.loads(line)
+    if "modelOutput" not in record:
+        raise ValueError(f"Record {record.get('recordId')} failed: {json.dumps(record.get('error'))}")
+    completion = record["modelOutput"]["output"]["message"]["content"][0]["text"]
+    save_attribution(record["recordId"], repair_json(completion), model_id)
+
+
+def outputs(job):
+    # Output files of the batch inference job, one per input file
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    _, _, prefix = job["outputUri"][len("s3://"):].partition("/")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".jsonl.out"))
+    return dict(job, outputs=keys)
+
+
+def collect(job):
+    """
+    Stream one batch inference output file into the product drafts with the same mapping as the online attribution
+    """
+    attributed = failed = 0
+    body = s3.get_object(Bucket=bucket_name, Key=job["key"])["Body"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(collect_record, line) for line in body.iter_lines() if line]
+        for future in futures:
+            try:
+                future.result()
+                attributed += 1
+            except Exception as e:
+                print(f"Error collecting batch record: {str(e)}")
+                failed += 1
+    return {"key": job["key"], "attributed": attributed, "collectFailed": failed}
+
+
+def lambda_handler(event, context):
+    # Invoked by the batch attribution workflow with the action of the state and the job state so far
+    print(json.dumps(event))
+    actions = {"plan": plan, "prepare": prepare, "submit": submit, "status": status, "outputs": outputs,
+               "collect": collect}
+    return actions[event["action"]](event["job"])
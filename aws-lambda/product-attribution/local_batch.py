@@ -0,0 +1,76 @@
+import json
+import uuid
+
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+class LocalBatchClient:
+    """
+    Stand-in for the Bedrock batch inference job API for testing, runs every record through InvokeModel
+    synchronously when the job is created and writes the output in the batch inference output format
+
+    Args:
+        runtime: Bedrock runtime client
+        s3: S3 client
+    """
+
+    def __init__(self, runtime, s3):
+        self.runtime = runtime
+        self.s3 = s3
+
+    def create_model_invocation_job(self, jobName, roleArn, modelId, inputDataConfig, outputDataConfig, **kwargs):
+        input_bucket, input_prefix = split_s3_uri(inputDataConfig["s3InputDataConfig"]["s3Uri"])
+        output_uri = outputDataConfig["s3OutputDataConfig"]["s3Uri"].rstrip("/") + "/" + str(uuid.uuid4())
+        output_bucket, output_prefix = split_s3_uri(output_uri)
+
+        # The input is a single JSONL file or a prefix of JSONL files, each gets its own output file
+        input_keys = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=input_bucket, Prefix=input_prefix):
+            input_keys.extend(obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".jsonl"))
+
+        processed = failed = 0
+        for input_key in input_keys:
+            lines = []
+            body = self.s3.get_object(Bucket=input_bucket, Key=input_key)["Body"]
+            for line in body.iter_lines():
+                if not line:
+                    continue
+                record = json.loads(line)
+                try:
+                    response = self.runtime.invoke_model(modelId=modelId, body=json.dumps(record["modelInput"]),
+                                                         accept="application/json", contentType="application/json")
+                    record["modelOutput"] = json.loads(response["body"].read())
+                    processed += 1
+                except Exception as e:
+                    record["error"] = {"errorMessage": str(e)}
+                    failed += 1
+                lines.append(json.dumps(record))
+
+            name = input_key.split("/")[-1]
+            self.s3.put_object(Bucket=output_bucket, Key=f"{output_prefix}/{name}.out", Body="\n".join(lines))
+
+        self.s3.put_object(Bucket=output_bucket, Key=f"{output_prefix}/manifest.json.out", Body=json.dumps({
+            "totalRecordCount": processed + failed,
+            "processedRecordCount": processed + failed,
+            "successRecordCount": processed,
+            "errorRecordCount": failed
+        }))
+        return {"jobArn": "local:" + output_uri}
+
+    def get_model_invocation_job(self, jobIdentifier):
+        output_uri = jobIdentifier[len("local:"):]
+        output_bucket, output_prefix = split_s3_uri(output_uri)
+        try:
+            self.s3.head_object(Bucket=output_bucket, Key=f"{output_prefix}/manifest.json.out")
+            status = "Completed"
+        except self.s3.exceptions.ClientError:
+            status = "Failed"
+        return {
+            "jobArn": jobIdentifier,
+            "status": status,
+            "outputDataConfig": {"s3OutputDataConfig": {"s3Uri": output_uri}}
+        }
@@ -0,0 +1,58 @@
+import functools
+import json
+import os
+
+from startup import LazyClient
+
+# Values serialized larger than this many bytes are stored in S3 and passed between states as a reference,
+# unset keeps every value inline in the state payload
+offload_threshold = int(os.environ.get("OffloadThresholdBytes") or -1)
+
+
+def _s3_client():
+    import boto3
+    return boto3.client("s3")
+
+
+# Created on the first offloaded or resolved value, also in eager startup mode as most payloads stay inline
+s3 = LazyClient(_s3_client)
+
+
+def offload(value, bucket, key):
+    """
+    Store a large state value in S3 and return a compact claim check reference instead
+
+    Args:
+        value: JSON serializable value
+        bucket: Bucket for the offloaded value
+        key: Object key for the offloaded value, e.g. state/<id>/<name>.json
+
+    Returns:
+        The value itself when offloading is disabled or it is small, else {"claimCheck": {"bucket", "key", "bytes"}}
+    """
+    if offload_threshold < 0:
+        return value
+    body = json.dumps(value).encode("utf-8")
+    if len(body) <= offload_threshold:
+        return value
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json")
+    return {"claimCheck": {"bucket": bucket, "key": key, "bytes": len(body)}}
+
+
+def is_claim_check(value):
+    return isinstance(value, dict) and "claimCheck" in value
+
+
+@functools.lru_cache(maxsize=32)
+def _load(bucket, key):
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    return obj['Body'].read()
+
+
+def resolve(value):
+    """
+    Value behind a claim check reference, values that were passed inline are returned unchanged
+    """
+    if not is_claim_check(value):
+        return value
+    return json.loads(_load(value["claimCheck"]["bucket"], value["claimCheck"]["key"]))
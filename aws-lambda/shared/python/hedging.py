@@ -0,0 +1,115 @@
+import concurrent.futures
+import os
+import threading
+import time
+from collections import deque
+
+# Hedging is opt-in: set HedgePercentile (e.g. 95) to issue a duplicate request once a call
+# runs longer than that latency percentile of the recent calls to the same model
+hedge_percentile = float(os.environ.get("HedgePercentile") or 0)
+# Maximum share of requests that may be duplicated, caps the extra model spend
+hedge_max_ratio = float(os.environ.get("HedgeMaxRatio", "0.05"))
+# Number of latency samples required per model before hedging kicks in
+hedge_min_samples = int(os.environ.get("HedgeMinSamples", "20"))
+
+
+class LatencyTracker:
+    """
+    Sliding window of recent call latencies per model id, kept for the lifetime of the Lambda container
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, model_id, seconds):
+        with self.lock:
+            self.samples.setdefault(model_id, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model_id, pct, min_samples=1):
+        """
+        Latency percentile in seconds for the model or None while there are fewer than min_samples
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(model_id, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class HedgeBudget:
+    """
+    Allows a hedge only while hedged requests stay below max_ratio of all requests
+    """
+
+    def __init__(self, max_ratio):
+        self.max_ratio = max_ratio
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def try_acquire(self):
+        with self.lock:
+            if self.hedges + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget(hedge_max_ratio)
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+
+def _timed(model_id, fn):
+    start = time.monotonic()
+    result = fn()
+    latency_tracker.record(model_id, time.monotonic() - start)
+    return result
+
+
+def hedged_call(model_id, fn):
+    """
+    Run fn, a model call for model_id, and duplicate it when it is slower than the hedge percentile
+
+    The first call to return wins, the other one is cancelled if not started yet or its result discarded.
+
+    Args:
+        model_id: Model id used to track latencies
+        fn: Callable without arguments performing the complete request including reading the response
+
+    Returns:
+        Result of whichever call finished first
+    """
+    hedge_budget.count_request()
+    threshold = latency_tracker.percentile(model_id, hedge_percentile, hedge_min_samples) if hedge_percentile else None
+    if threshold is None:
+        return _timed(model_id, fn)
+
+    primary = executor.submit(_timed, model_id, fn)
+    try:
+        return primary.result(timeout=threshold)
+    except concurrent.futures.TimeoutError:
+        pass
+
+    if not hedge_budget.try_acquire():
+        return primary.result()
+
+    print(f"Hedging {model_id} request after {threshold:.2f}s")
+    pending = {primary, executor.submit(_timed, model_id, fn)}
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                return future.result()
+            error = future.exception()
+    raise error
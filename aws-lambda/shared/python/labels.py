@@ -0,0 +1,110 @@
+import json
+import time
+
+# DetectLabels parameters, part of the cache key so results of other settings are never reused
+min_confidence = 90
+max_dominant_colors = 3
+
+
+def summarize_labels(labels):
+    """
+    Compact structure of the Rekognition labels used for attribution
+
+    The label with instances is the detected product, the other labels become alias and category tags.
+
+    Args:
+        labels: Labels of a Rekognition DetectLabels response
+
+    Returns:
+        Dictionary with label, categories, boundingBox, colorPalette, categoryTags and aliasTags
+
+    Raises:
+        ValueError: If none of the labels has an instance
+    """
+    detected_label = None
+    tags = []
+    category_tags = []
+    for label in labels:
+        if "Instances" in label and len(label["Instances"]) > 0:
+            detected_label = label
+        else:
+            tags.append(label["Name"])
+            tags.extend([c["Name"] for c in label["Aliases"]])
+            category_tags.extend([c["Name"] for c in label["Categories"]])
+            if "Parents" in label:
+                for p in label["Parents"]:
+                    category_tags.append(p["Name"])
+
+    if detected_label is None:
+        raise ValueError("No product detected in the image")
+
+    categories = [c["Name"] for c in detected_label["Categories"]]
+    categories.append(detected_label["Name"])
+    if "Parents" in detected_label:
+        for p in detected_label["Parents"]:
+            categories.insert(0, p["Name"])
+
+    return {
+        'label': detected_label["Name"],
+        'categories': categories,
+        'boundingBox': detected_label["Instances"][0]["BoundingBox"],
+        'colorPalette': [c["HexCode"] for c in detected_label["Instances"][0]["DominantColors"]],
+        'categoryTags': sorted(set(category_tags)),
+        'aliasTags': sorted(set(tags))
+    }
+
+
+def content_hash(s3, bucket, key):
+    """
+    Content identifier of an S3 object from its metadata, without reading the object
+
+    Uses the SHA-256 checksum when the object was uploaded with one, else the ETag.
+    """
+    head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+    if "ChecksumSHA256" in head:
+        return "sha256:" + head["ChecksumSHA256"]
+    return "etag:" + head["ETag"].strip('"')
+
+
+def detect_labels_cached(rekognition, s3, ddb, table_name, bucket, key, ttl_seconds):
+    """
+    Label summary of an image, served from the cache table when the same content was analysed before
+
+    Args:
+        rekognition: Rekognition client
+        s3: S3 client
+        ddb: DynamoDB client
+        table_name: Cache table with partition key ContentHash and TTL attribute ExpiresAt
+        bucket: Image bucket
+        key: Image key
+        ttl_seconds: Lifetime of cached results, 0 disables the cache
+
+    Returns:
+        Tuple of (label summary, cache hit flag)
+    """
+    cache_key = None
+    if ttl_seconds > 0:
+        cache_key = f"{content_hash(s3, bucket, key)}#{min_confidence}#{max_dominant_colors}"
+        item = ddb.get_item(TableName=table_name, Key={"ContentHash": {"S": cache_key}}).get("Item")
+        # Expired items are deleted by the DynamoDB TTL process eventually, not immediately
+        if item and float(item["ExpiresAt"]["N"]) > time.time():
+            return json.loads(item["Summary"]["S"]), True
+
+    response = rekognition.detect_labels(
+        Features=["GENERAL_LABELS", "IMAGE_PROPERTIES"],
+        Image={"S3Object": {"Bucket": bucket, "Name": key}},
+        MinConfidence=min_confidence,
+        Settings={"ImageProperties": {"MaxDominantColors": max_dominant_colors}}
+    )
+    summary = summarize_labels(response["Labels"])
+
+    if cache_key:
+        ddb.put_item(
+            TableName=table_name,
+            Item={
+                "ContentHash": {"S": cache_key},
+                "Summary": {"S": json.dumps(summary, separators=(",", ":"))},
+                "ExpiresAt": {"N": str(int(time.time() + ttl_seconds))}
+            }
+        )
+    return summary, False
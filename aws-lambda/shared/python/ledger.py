@@ -0,0 +1,197 @@
+import functools
+import json
+import os
+import threading
+import time
+
+from startup import LazyClient, lazy_client
+
+# Usage records are written to the LedgerTableName table, or to the SQLite database LedgerSqlitePath as a
+# local stand-in, and not at all when neither is set
+ledger_table_name = os.environ.get("LedgerTableName", "")
+ledger_sqlite_path = os.environ.get("LedgerSqlitePath", "")
+ledger_ttl_days = int(os.environ.get("LedgerTtlDays", "90"))
+
+ddb = lazy_client('dynamodb')
+
+# One invocation at a time per Lambda execution environment, worker threads add to the same record
+_lock = threading.Lock()
+_record = None
+
+
+def enabled():
+    return bool(ledger_table_name or ledger_sqlite_path)
+
+
+def add(counter, value=1):
+    """
+    Add to a counter of the current usage record, e.g. CanvasCacheHits
+    """
+    _add(_record, counter, value)
+
+
+def add_model_usage(model_id, input_tokens=0, output_tokens=0, images=0):
+    _add_model_usage(_record, model_id, input_tokens, output_tokens, images)
+
+
+def _add(record, counter, value=1):
+    with _lock:
+        if record is not None:
+            record[counter] = record.get(counter, 0) + value
+
+
+def _add_model_usage(record, model_id, input_tokens=0, output_tokens=0, images=0):
+    with _lock:
+        if record is None:
+            return
+        usage = record["Models"].setdefault(model_id, {"Requests": 0, "InputTokens": 0, "OutputTokens": 0,
+                                                        "Images": 0})
+        usage["Requests"] += 1
+        usage["InputTokens"] += input_tokens
+        usage["OutputTokens"] += output_tokens
+        usage["Images"] += images
+
+
+def set_category(category):
+    with _lock:
+        if _record is not None and category:
+            _record["Category"] = category
+
+
+def _body_length(body):
+    # Request bodies may already have been wrapped into a file-like object by botocore
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, bytes):
+        return len(body)
+    try:
+        position = body.tell()
+        length = body.seek(0, 2) - position
+        body.seek(position)
+        return length
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def _before_parameter_build(params, context, **kwargs):
+    # The usage is added to the record of the invocation that made the request, a hedged request still
+    # running when the handler returns must not be counted into the next invocation
+    context["ledger_record"] = _record
+    context["ledger_params"] = params
+    context["ledger_body_bytes"] = _body_length(params.get("Body", b""))
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    if http_response.status_code >= 300:
+        return
+    service = model.service_model.service_name
+    params = context.get("ledger_params", {})
+    record = context.get("ledger_record")
+    if service == "bedrock-runtime":
+        if model.name in ("Converse", "ConverseStream"):
+            usage = parsed.get("usage", {})
+            _add_model_usage(record, params.get("modelId"), usage.get("inputTokens", 0), usage.get("outputTokens", 0))
+        elif model.name == "InvokeModel":
+            # Image generation requests are counted by the requested number of images
+            try:
+                config = json.loads(params.get("body", "{}")).get("imageGenerationConfig", {})
+            except (TypeError, ValueError):
+                config = {}
+            _add_model_usage(record, params.get("modelId"), images=config.get("numberOfImages", 1) if config else 0)
+    elif service == "rekognition":
+        _add(record, "RekognitionCalls")
+    elif service == "s3":
+        if model.name == "GetObject":
+            _add(record, "S3BytesRead", parsed.get("ContentLength", 0))
+        elif model.name == "PutObject":
+            _add(record, "S3BytesWritten", context.get("ledger_body_bytes", 0))
+
+
+def instrument(client):
+    """
+    Count the model, Rekognition and S3 usage of a boto3 client (or resource) into the current record
+
+    A lazy client is instrumented when it is created, so clients a function never uses are not created.
+    """
+    if isinstance(client, LazyClient):
+        client.on_create(instrument)
+        return
+    client = getattr(client.meta, "client", None) or client
+    client.meta.events.register("before-parameter-build", _before_parameter_build, unique_id="ledger-params")
+    client.meta.events.register("after-call", _after_call, unique_id="ledger-usage")
+
+
+def _to_attribute(value):
+    if isinstance(value, dict):
+        return {"M": {k: _to_attribute(v) for k, v in value.items()}}
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+    return {"S": str(value)}
+
+
+def _write(record):
+    day = time.strftime("%Y-%m-%d", time.gmtime(record["RecordedAt"]))
+    record_key = f"{record['RecordedAt']:.3f}#{record['Function']}#{record['Id']}"
+    if ledger_table_name:
+        item = {k: _to_attribute(v) for k, v in record.items()}
+        item.update({"Day": {"S": day}, "RecordKey": {"S": record_key},
+                     "ExpiresAt": {"N": str(int(record["RecordedAt"]) + ledger_ttl_days * 86400)}})
+        ddb.put_item(TableName=ledger_table_name, Item=item)
+    else:
+        import sqlite3
+        with sqlite3.connect(ledger_sqlite_path) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS ledger (day TEXT, record_key TEXT PRIMARY KEY, record TEXT)")
+            connection.execute("INSERT OR REPLACE INTO ledger VALUES (?, ?, ?)", (day, record_key, json.dumps(record)))
+
+
+def recorded(function_name, keys, clients=()):
+    """
+    Decorator recording one compact usage record per invocation of a Lambda handler
+
+    The record holds the Id, execution id, category, duration, memory size, requests and tokens or images
+    per model, Rekognition calls and S3 bytes read and written. Recording errors never fail the handler.
+
+    Args:
+        function_name: Name of the function in the records
+        keys: Function returning the tuple (Id, execution id) of a handler event
+        clients: boto3 clients or resources whose calls are counted
+    """
+    def decorator(handler):
+        if enabled():
+            for client in clients:
+                instrument(client)
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _record
+            if not enabled():
+                return handler(event, context)
+
+            start = time.time()
+            try:
+                id, execution_id = keys(event)
+            except Exception as e:
+                print(f"Error starting usage record: {str(e)}")
+                return handler(event, context)
+
+            with _lock:
+                _record = {"Id": id, "ExecutionId": execution_id or id, "Function": function_name,
+                           "Category": "unknown", "Status": "ok", "Models": {}, "RekognitionCalls": 0,
+                           "S3BytesRead": 0, "S3BytesWritten": 0}
+            try:
+                return handler(event, context)
+            except Exception:
+                _record["Status"] = "error"
+                raise
+            finally:
+                with _lock:
+                    record, _record = _record, None
+                record["RecordedAt"] = time.time()
+                record["DurationMs"] = int((record["RecordedAt"] - start) * 1000)
+                record["MemoryMb"] = int(getattr(context, "memory_limit_in_mb", 0) or 0)
+                try:
+                    _write(record)
+                except Exception as e:
+                    print(f"Error writing usage record: {str(e)}")
+        return wrapper
+    return decorator
@@ -0,0 +1,115 @@
+import re
+
+from structured_output import converse_structured
+
+# Matches the example JSON lines of a prompt template e.g. ` "Title": "",` or `"bathroom_amenities": [...],`
+ATTRIBUTE_PATTERN = re.compile(r'^\s*"([^"]+)"\s*:\s*(.*?)\s*,?\s*$', re.MULTILINE)
+
+
+def template_schema(template):
+    """
+    Build the attribute schema of a prompt template from its example JSON
+
+    Args:
+        template: Prompt template text containing an example JSON output
+
+    Returns:
+        Dictionary of attribute name to JSON type (string, number, boolean or array)
+    """
+    schema = {}
+    for name, value in ATTRIBUTE_PATTERN.findall(template):
+        if value.startswith("["):
+            schema[name] = "array"
+        elif value in ("true", "false"):
+            schema[name] = "boolean"
+        elif re.match(r'^-?\d', value):
+            schema[name] = "number"
+        else:
+            schema[name] = "string"
+    return schema
+
+
+def completeness(attribution, schema, core_attributes=None):
+    """
+    Fraction of the core attributes that were filled in by the model
+
+    Only core attributes are scored because templates ask the model to leave attributes empty that don't apply,
+    all schema attributes are scored when none of the core attributes is in the schema. Booleans count as filled
+    whenever present, strings, lists and numbers only when non-empty/non-zero.
+    """
+    names = [name for name in core_attributes or [] if name in schema] or list(schema)
+    if not names:
+        return 1.0
+    filled = 0
+    for name in names:
+        value = attribution.get(name)
+        if isinstance(value, bool) or value not in (None, "", [], 0):
+            filled += 1
+    return filled / len(names)
+
+
+def converse_with_routing(bedrock, model_tiers, messages, schema, min_completeness, inference_config,
+                          output_mode="text", core_attributes=None):
+    """
+    Call the model tiers cheapest first and escalate until the attribution is valid and complete enough
+
+    Args:
+        bedrock: Bedrock runtime client
+        model_tiers: Model ids ordered from cheapest to most capable
+        messages: Converse API messages
+        schema: Attribute schema returned by template_schema
+        min_completeness: Minimum completeness required to accept a non-final tier
+        inference_config: Converse API inference configuration
+        output_mode: "tool" for tool use constrained output, "text" for parsing the free text completion
+        core_attributes: Attributes every item has, the completeness is scored on these
+
+    Returns:
+        Dictionary with modelId, completion, attribution, usage, completeness and escalated flag
+    """
+    for tier, model_id in enumerate(model_tiers):
+        is_last = tier == len(model_tiers) - 1
+        try:
+            # Only the final tier re-asks for invalid attributes, earlier tiers escalate instead
+            completion, attribution, usage = converse_structured(bedrock, model_id, messages, schema,
+                                                                 inference_config, output_mode, reask=is_last)
+        except Exception as e:
+            if is_last:
+                raise
+            print(f"Escalating from {model_id}: {str(e)}")
+            continue
+
+        score = completeness(attribution, schema, core_attributes)
+        if score < min_completeness and not is_last:
+            print(f"Escalating from {model_id}: completeness {score:.2f} below {min_completeness}")
+            continue
+
+        return {
+            'modelId': model_id,
+            'completion': completion,
+            'attribution': attribution,
+            'usage': usage,
+            'completeness': score,
+            'escalated': tier > 0
+        }
+
+
+def record_routing_stats(ddb, table_name, category, result):
+    """
+    Increment the routing counters of a category in the routing stats table (partition key Category)
+    """
+    if not table_name:
+        return
+    try:
+        ddb.update_item(
+            TableName=table_name,
+            Key={'Category': {'S': category}},
+            UpdateExpression="ADD Requests :one, Escalations :escalated, CompletenessTotal :score, #model :one",
+            ExpressionAttributeNames={"#model": f"AcceptedBy:{result['modelId']}"},
+            ExpressionAttributeValues={
+                ":one": {"N": "1"},
+                ":escalated": {"N": "1" if result["escalated"] else "0"},
+                ":score": {"N": f"{result['completeness']:.4f}"}
+            }
+        )
+    except Exception as e:
+        print(f"Error recording routing stats: {str(e)}")
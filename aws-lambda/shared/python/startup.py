@@ -0,0 +1,115 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+
+# "eager" creates clients and loads templates at import time, "lazy" defers this to the first use. Lazy only
+# moves the work from the init phase into the first invocation, see tools/coldstart.py benchmark
+startup_mode = os.environ.get("StartupMode", "eager")
+
+# boto3 session setup is not thread safe, clients used from worker threads are created one at a time
+_lock = threading.Lock()
+
+
+class LazyClient:
+    """
+    Proxy creating a boto3 client or resource on first attribute access
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._callbacks = []
+
+    def get(self):
+        if self._instance is None:
+            with _lock:
+                if self._instance is None:
+                    instance = self._factory()
+                    for callback in self._callbacks:
+                        callback(instance)
+                    self._instance = instance
+        return self._instance
+
+    def on_create(self, callback):
+        """
+        Call callback with the client or resource once it is created, right away when it already exists
+        """
+        with _lock:
+            if self._instance is None:
+                self._callbacks.append(callback)
+                return
+        callback(self._instance)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def _lazy(factory):
+    proxy = LazyClient(factory)
+    if startup_mode == "eager":
+        proxy.get()
+    return proxy
+
+
+def lazy_client(*args, **kwargs):
+    """
+    boto3.client(*args, **kwargs) created on first use, boto3 itself is only imported then
+    """
+    def factory():
+        import boto3
+        return boto3.client(*args, **kwargs)
+    return _lazy(factory)
+
+
+def lazy_resource(*args, **kwargs):
+    """
+    boto3.resource(*args, **kwargs) created on first use, boto3 itself is only imported then
+    """
+    def factory():
+        import boto3
+        return boto3.resource(*args, **kwargs)
+    return _lazy(factory)
+
+
+def template_digest(template):
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+
+@functools.cache
+def _precompiled_templates():
+    # templates.json is generated by tools/precompile_templates.py into the function directory
+    if not os.path.exists("templates.json"):
+        return {}
+    with open("templates.json", "r") as file:
+        return json.load(file)
+
+
+@functools.cache
+def load_template(name):
+    """
+    Prompt template and its attribute schema from <name>-template.txt, the schema is taken from templates.json
+    when it was precompiled from the same template text and parsed otherwise
+
+    Returns:
+        Tuple of (template text, attribute schema)
+    """
+    with open(f"{name}-template.txt", "r") as file:
+        template = file.read()
+    precompiled = _precompiled_templates().get(name)
+    if precompiled and precompiled.get("sha256") == template_digest(template):
+        return template, precompiled["schema"]
+    if precompiled:
+        print(f"templates.json is stale for {name}, parsing {name}-template.txt")
+
+    from model_routing import template_schema
+    return template, template_schema(template)
+
+
+def run_at_init(hook):
+    """
+    Run hook at import time in eager startup mode, e.g. to import the libraries used by the first invocation
+    """
+    if startup_mode == "eager":
+        hook()
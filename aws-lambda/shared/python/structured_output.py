@@ -0,0 +1,145 @@
+import json
+import re
+
+from hedging import hedged_call
+
+TOOL_NAME = "record_attributes"
+
+JSON_TYPES = {
+    "string": str,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list
+}
+
+
+def json_schema(schema):
+    """
+    JSON schema of the attribution object for an attribute schema returned by template_schema
+    """
+    properties = {}
+    for name, json_type in schema.items():
+        properties[name] = {"type": json_type}
+        if json_type == "array":
+            properties[name]["items"] = {"type": "string"}
+    return {"type": "object", "properties": properties, "required": list(schema)}
+
+
+def tool_config(schema):
+    """
+    Converse API tool configuration forcing the model to return the attributes as tool input
+    """
+    return {
+        "tools": [{
+            "toolSpec": {
+                "name": TOOL_NAME,
+                "description": "Record the attributes generated from the images. Leave attributes empty which can not be generated.",
+                "inputSchema": {"json": json_schema(schema)}
+            }
+        }],
+        "toolChoice": {"tool": {"name": TOOL_NAME}}
+    }
+
+
+def repair_json(text):
+    """
+    Parse a model completion as a JSON object, tolerating the usual formatting mistakes
+
+    Handles markdown code fences, text around the object, missing commas between attributes,
+    trailing commas, typographic quotes and Python style booleans.
+
+    Raises:
+        ValueError: If the completion can not be repaired into a JSON object
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("No JSON object found in completion")
+    candidate = text[start:end + 1]
+    try:
+        return json.loads(candidate)
+    except ValueError:
+        pass
+
+    candidate = candidate.replace("“", '"').replace("”", '"')
+    candidate = re.sub(r'(:\s*)True\b', r'\1true', candidate)
+    candidate = re.sub(r'(:\s*)False\b', r'\1false', candidate)
+    # Missing comma between a value and the next key
+    candidate = re.sub(r'([\d"\]}]|true|false|null)(\s+"[^"\n]*"\s*:)', r'\1,\2', candidate)
+    # Trailing comma before a closing bracket
+    candidate = re.sub(r',(\s*[}\]])', r'\1', candidate)
+    return json.loads(candidate)
+
+
+def invalid_fields(attribution, schema):
+    """
+    Attributes of the schema that are missing from the attribution or have the wrong type
+    """
+    invalid = []
+    for name, json_type in schema.items():
+        value = attribution.get(name)
+        expected = JSON_TYPES[json_type]
+        if value is None or not isinstance(value, expected) or (json_type == "number" and isinstance(value, bool)):
+            invalid.append(name)
+    return invalid
+
+
+def _converse(bedrock, model_id, messages, schema, inference_config, output_mode):
+    kwargs = {"modelId": model_id, "messages": messages, "inferenceConfig": inference_config}
+    if output_mode == "tool":
+        kwargs["toolConfig"] = tool_config(schema)
+    response = hedged_call(model_id, lambda: bedrock.converse(**kwargs))
+
+    content = response['output']['message']['content']
+    for block in content:
+        if "toolUse" in block:
+            return response, json.dumps(block["toolUse"]["input"]), block["toolUse"]["input"]
+    completion = "".join(block.get("text", "") for block in content)
+    try:
+        return response, completion, repair_json(completion)
+    except ValueError as e:
+        print(f"Unable to parse completion of {model_id}: {str(e)}")
+        return response, completion, None
+
+
+def converse_structured(bedrock, model_id, messages, schema, inference_config, output_mode="text", reask=True):
+    """
+    Generate an attribution with a single model and re-ask once for invalid attributes only
+
+    Args:
+        bedrock: Bedrock runtime client
+        model_id: Model id to call
+        messages: Converse API messages
+        schema: Attribute schema returned by template_schema
+        inference_config: Converse API inference configuration
+        output_mode: "tool" to constrain the output with tool use, "text" to parse the free text completion
+        reask: Whether to ask the model again for the attributes that are missing or invalid
+
+    Returns:
+        Tuple of (completion, attribution, usage)
+
+    Raises:
+        ValueError: If no JSON object could be obtained from the model
+    """
+    response, completion, attribution = _converse(bedrock, model_id, messages, schema, inference_config, output_mode)
+    usage = dict(response.get('usage', {}))
+    invalid = invalid_fields(attribution, schema) if isinstance(attribution, dict) else list(schema)
+
+    if invalid and reask:
+        print(f"Re-asking {model_id} for attributes: {invalid}")
+        reask_schema = {name: schema[name] for name in invalid}
+        reask_messages = messages + [
+            {"role": "assistant", "content": [{"text": completion or "{}"}]},
+            {"role": "user", "content": [{"text": "Return only a JSON object with the following attributes, using "
+                                                  "these JSON types: " + json.dumps(reask_schema)}]}
+        ]
+        response, _, fixed = _converse(bedrock, model_id, reask_messages, reask_schema, inference_config, output_mode)
+        for k, v in response.get('usage', {}).items():
+            usage[k] = usage.get(k, 0) + v
+        if isinstance(fixed, dict):
+            attribution = attribution if isinstance(attribution, dict) else {}
+            attribution.update({name: fixed[name] for name in invalid if name in fixed})
+            completion = json.dumps(attribution)
+
+    if not isinstance(attribution, dict):
+        raise ValueError(f"Model {model_id} did not return a JSON object")
+    return completion, attribution, usage
@@ -0,0 +1,61 @@
+import json
+import os
+import urllib.parse
+
+from startup import lazy_client
+
+s3 = lazy_client('s3')
+sfn = lazy_client('stepfunctions')
+
+# Workflows the browser may request in a manifest, the state machine ARNs are never taken from the manifest
+state_machines = {
+    "catalog": os.environ["StateMachineArn"],
+    "attribution": os.environ["AttributionStateMachineArn"]
+}
+
+
+def read_manifest(bucket, key):
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    return json.loads(obj['Body'].read())
+
+
+def uploaded_keys(manifest):
+    # Keys of the images referenced by the execution input
+    execution_input = manifest["input"]
+    keys = list(execution_input.get("paths", []))
+    for field in ["path", "humanModel"]:
+        if field in execution_input:
+            keys.append(execution_input[field])
+    return keys
+
+
+def lambda_handler(event, context):
+    print(json.dumps(event))
+    executions = []
+    for record in event["Records"]:
+        bucket = record["s3"]["bucket"]["name"]
+        key = urllib.parse.unquote_plus(record["s3"]["object"]["key"])
+        manifest = read_manifest(bucket, key)
+        id = manifest["id"]
+
+        if key != f"input/requests/{id}.json" or manifest["input"].get("id") != id:
+            raise ValueError(f"Manifest {key} does not match its id {id}")
+        keys = uploaded_keys(manifest)
+        if not keys:
+            raise ValueError(f"Manifest {key} does not reference any image")
+        for image_key in keys:
+            # Only images uploaded for this id may be referenced, they must exist before the execution starts
+            if not image_key.startswith(("input/" + id, "input/attributions/" + id)):
+                raise ValueError(f"Manifest {key} references foreign object {image_key}")
+            s3.head_object(Bucket=bucket, Key=image_key)
+
+        # The execution is named after the id, a duplicate notification does not start a second execution
+        try:
+            execution = sfn.start_execution(stateMachineArn=state_machines[manifest["workflow"]], name=id,
+                                            input=json.dumps(manifest["input"]))
+            print(execution["executionArn"])
+            executions.append(execution["executionArn"])
+        except sfn.exceptions.ExecutionAlreadyExists:
+            print(f"Execution {id} already started")
+
+    return {'executions': executions}
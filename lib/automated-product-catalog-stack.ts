@@ -2,9 +2,10 @@ import * as cdk from 'aws-cdk-lib';
 import {Aws, CfnOutput, Duration} from 'aws-cdk-lib';
 import {Construct} from 'constructs';
 import {DefinitionBody, LogLevel, StateMachine} from "aws-cdk-lib/aws-stepfunctions";
-import {BlockPublicAccess, Bucket} from "aws-cdk-lib/aws-s3";
-import {Code, Function, Runtime} from "aws-cdk-lib/aws-lambda";
-import {ManagedPolicy, PolicyStatement} from "aws-cdk-lib/aws-iam";
+import {BlockPublicAccess, Bucket, EventType, HttpMethods} from "aws-cdk-lib/aws-s3";
+import {LambdaDestination} from "aws-cdk-lib/aws-s3-notifications";
+import {Code, Function, LayerVersion, Runtime} from "aws-cdk-lib/aws-lambda";
+import {ManagedPolicy, PolicyStatement, Role, ServicePrincipal} from "aws-cdk-lib/aws-iam";
 import {AttributeType, Table, TableEncryption} from "aws-cdk-lib/aws-dynamodb";
 import {DockerImageAsset, Platform} from "aws-cdk-lib/aws-ecr-assets";
 import {GatewayVpcEndpointAwsService, InterfaceVpcEndpointAwsService, SubnetType, Vpc} from "aws-cdk-lib/aws-ec2";
@@ -50,7 +51,22 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             enforceSSL: true,
             blockPublicAccess: BlockPublicAccess.BLOCK_ALL,
             autoDeleteObjects: true,
-            removalPolicy: cdk.RemovalPolicy.DESTROY
+            removalPolicy: cdk.RemovalPolicy.DESTROY,
+            // Direct uploads from the browser through the SSM port forwarding of the Streamlit UI
+            cors: [{
+                allowedMethods: [HttpMethods.POST],
+                allowedOrigins: ["http://localhost:8501"],
+                allowedHeaders: ["*"]
+            }],
+            lifecycleRules: [{
+                // Offloaded Step Functions state values are only read while the execution runs
+                prefix: "state/",
+                expiration: Duration.days(7)
+            }, {
+                // Cached Nova Canvas responses of the deterministic seed mode, several MB each
+                prefix: "output/cache/",
+                expiration: Duration.days(30)
+            }]
         });
 
         const table = new Table(this, "ProductDrafts", {
@@ -61,38 +77,94 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             }
         });
 
+        // Per category counters of the attribution model routing
+        const routingStatsTable = new Table(this, "RoutingStats", {
+            partitionKey: {name: "Category", type: AttributeType.STRING},
+            encryption: TableEncryption.AWS_MANAGED,
+            pointInTimeRecoverySpecification: {
+                pointInTimeRecoveryEnabled: true
+            }
+        });
+
+        // Usage record per function invocation for cost and capacity reporting, see tools/ledger_report.py
+        const ledgerTable = new Table(this, "UsageLedger", {
+            partitionKey: {name: "Day", type: AttributeType.STRING},
+            sortKey: {name: "RecordKey", type: AttributeType.STRING},
+            encryption: TableEncryption.AWS_MANAGED,
+            timeToLiveAttribute: "ExpiresAt",
+            pointInTimeRecoverySpecification: {
+                pointInTimeRecoveryEnabled: true
+            },
+            removalPolicy: cdk.RemovalPolicy.DESTROY
+        });
+
         const textModelId = "amazon.nova-pro-v1:0";
+        // Cheaper model tried first for attribution, escalating to textModelId for invalid or sparse output
+        const fastTextModelId = "amazon.nova-lite-v1:0";
         const imageModelId = "amazon.nova-canvas-v1:0";
+
+        // Helpers shared by the Python Lambda functions (model routing etc.)
+        const sharedLayer = new LayerVersion(this, "SharedLayer", {
+            code: Code.fromAsset("./aws-lambda/shared"),
+            compatibleRuntimes: [Runtime.PYTHON_3_13],
+            description: "Shared helpers for the product catalog Lambda functions"
+        });
+
         const productAttributionFn = new Function(this, "ProductAttributionFn", {
             code: Code.fromAsset("./aws-lambda/product-attribution"),
             handler: "app.lambda_handler",
             runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
             environment: {
                 "ImageBucketName": imagesBucket.bucketName,
                 "ModelId": textModelId,
-                "TableName": table.tableName
+                "FastModelId": fastTextModelId,
+                "MinCompleteness": "0.6",
+                "OutputMode": "tool",
+                "TableName": table.tableName,
+                "RoutingStatsTableName": routingStatsTable.tableName,
+                "LedgerTableName": ledgerTable.tableName
             },
             timeout: Duration.minutes(1)
         });
         productAttributionFn.addToRolePolicy(new PolicyStatement({
             actions: ["bedrock:InvokeModel"],
-            resources: ["arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + textModelId]
+            resources: [
+                "arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + textModelId,
+                "arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + fastTextModelId
+            ]
         }));
 
-        const genericAttributionFn = new Function(this, "GenericAttributionFn", {
-            code: Code.fromAsset("./aws-lambda/generic-attribution"),
-            handler: "app.lambda_handler",
+        // Bundled with its requirements (Pillow) for image down-selection
+        const genericAttributionFn = new PythonFunction(this, "GenericAttributionFn", {
+            entry: "./aws-lambda/generic-attribution",
+            index: "app.py",
+            handler: "lambda_handler",
             runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
             environment: {
                 "ImageBucketName": imagesBucket.bucketName,
                 "ModelId": textModelId,
-                "TableName": table.tableName
+                "FastModelId": fastTextModelId,
+                "MinCompleteness": "0.6",
+                "OutputMode": "tool",
+                "MaxImages": "5",
+                "ImageTokenBudget": "6000",
+                "MaxImageEdge": "1024",
+                "TableName": table.tableName,
+                "RoutingStatsTableName": routingStatsTable.tableName,
+                "LedgerTableName": ledgerTable.tableName
             },
+            // Decoding and downscaling of up to 20 MB uploads before the down-selection
+            memorySize: 1024,
             timeout: Duration.minutes(1)
         });
         genericAttributionFn.addToRolePolicy(new PolicyStatement({
             actions: ["bedrock:InvokeModel"],
-            resources: ["arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + textModelId]
+            resources: [
+                "arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + textModelId,
+                "arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + fastTextModelId
+            ]
         }));
 
         // Nova Canvas is used for virtual try-on
@@ -100,12 +172,18 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             entry: "./aws-lambda/image-try-on",
             handler: "lambda_handler",
             runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
             environment: {
                 "ImageBucketName": imagesBucket.bucketName,
                 "TableName": table.tableName,
                 "ModelId": imageModelId,
+                "DeterministicSeeds": "false",
+                "LedgerTableName": ledgerTable.tableName
             },
-            timeout: Duration.minutes(2)
+            // Image encoding and quality scoring are CPU bound, Lambda allocates CPU proportional to memory
+            memorySize: 1769,
+            // Leaves room to regenerate try-on results failing the quality checks
+            timeout: Duration.minutes(3)
         });
         imageGenerationTryOn.addToRolePolicy(new PolicyStatement({
             actions: ["bedrock:InvokeModel"],
@@ -117,12 +195,76 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             ]
         }));
 
+        // Rekognition DetectLabels results cached by image content hash, expired by DynamoDB TTL
+        const labelCacheTable = new Table(this, "LabelCache", {
+            partitionKey: {name: "ContentHash", type: AttributeType.STRING},
+            encryption: TableEncryption.AWS_MANAGED,
+            timeToLiveAttribute: "ExpiresAt",
+            pointInTimeRecoverySpecification: {
+                pointInTimeRecoveryEnabled: true
+            },
+            removalPolicy: cdk.RemovalPolicy.DESTROY
+        });
+        const labelDetectionFn = new Function(this, "LabelDetectionFn", {
+            code: Code.fromAsset("./aws-lambda/label-detection"),
+            handler: "app.lambda_handler",
+            runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
+            environment: {
+                "ImageBucketName": imagesBucket.bucketName,
+                "LabelCacheTableName": labelCacheTable.tableName,
+                "LabelCacheTtlSeconds": "604800",
+                "OffloadThresholdBytes": "4096",
+                "LedgerTableName": ledgerTable.tableName
+            },
+            timeout: Duration.seconds(30)
+        });
+        labelDetectionFn.addToRolePolicy(new PolicyStatement({
+            actions: ["rekognition:DetectLabels"],
+            resources: ["*"]
+        }));
+        labelCacheTable.grantReadWriteData(labelDetectionFn);
+
+        // Translations of short repeated attribute values, shared by all products
+        const phraseTable = new Table(this, "PhraseDictionary", {
+            partitionKey: {name: "Phrase", type: AttributeType.STRING},
+            encryption: TableEncryption.AWS_MANAGED,
+            pointInTimeRecoverySpecification: {
+                pointInTimeRecoveryEnabled: true
+            },
+            removalPolicy: cdk.RemovalPolicy.DESTROY
+        });
+        // Comma separated locales, e.g. "fr-FR,de-DE,es-ES", empty skips the localization state
+        const locales = "";
+        const localizationFn = new Function(this, "LocalizationFn", {
+            code: Code.fromAsset("./aws-lambda/localization"),
+            handler: "app.lambda_handler",
+            runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
+            environment: {
+                "ModelId": fastTextModelId,
+                "TableName": table.tableName,
+                "PhraseTableName": phraseTable.tableName,
+                "Locales": locales
+            },
+            timeout: Duration.minutes(2)
+        });
+        localizationFn.addToRolePolicy(new PolicyStatement({
+            actions: ["bedrock:InvokeModel"],
+            resources: ["arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + fastTextModelId]
+        }));
+        phraseTable.grantReadWriteData(localizationFn);
+        table.grant(localizationFn, "dynamodb:BatchGetItem");
+        table.grant(localizationFn, "dynamodb:UpdateItem");
+
         const logGroup = new cdk.aws_logs.LogGroup(this, "stateMachineLogGroup");
         const stepFn = new StateMachine(this, "stateMachine", {
             timeout: Duration.minutes(10),
             definitionBody: DefinitionBody.fromFile("./workflow.asl.json"),
             definitionSubstitutions: {
-                "ImageBucketName": imagesBucket.bucketName,
+                "LabelDetectionFnArn": labelDetectionFn.functionArn,
+                "LocalizationFnArn": localizationFn.functionArn,
+                "Locales": locales,
                 "ProductAttributionFnArn": productAttributionFn.functionArn,
                 "ImageGenerationFnArn": imageGenerationTryOn.functionArn,
             },
@@ -140,25 +282,106 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             logs: {level: LogLevel.ALL, includeExecutionData: false, destination: logGroup}
         });
 
-        stepFn.addToRolePolicy(new PolicyStatement({
-            actions: ["rekognition:DetectLabels"],
-            resources: ["*"]
-        }));
-        imagesBucket.grantRead(stepFn, "input/*")
+        imagesBucket.grantRead(labelDetectionFn, "input/*")
         imagesBucket.grantRead(attrStepFn, "input/*")
         imagesBucket.grantRead(genericAttributionFn, "input/*")
         imagesBucket.grantRead(productAttributionFn, "input/*")
+        imagesBucket.grantWrite(labelDetectionFn, "state/*")
+        imagesBucket.grantRead(productAttributionFn, "state/*")
+        imagesBucket.grantRead(imageGenerationTryOn, "state/*")
         imagesBucket.grantRead(imageGenerationTryOn, "input/*")
         imagesBucket.grantReadWrite(imageGenerationTryOn, "human-model-images/*")
         imagesBucket.grantWrite(imageGenerationTryOn, "output/*")
+        imagesBucket.grantRead(imageGenerationTryOn, "output/cache/*")
         genericAttributionFn.grantInvoke(attrStepFn);
+        labelDetectionFn.grantInvoke(stepFn);
         productAttributionFn.grantInvoke(stepFn);
+        localizationFn.grantInvoke(stepFn);
         imageGenerationTryOn.grantInvoke(stepFn);
         table.grant(genericAttributionFn, "dynamodb:PutItem");
         table.grant(genericAttributionFn, "dynamodb:UpdateItem");
         table.grant(productAttributionFn, "dynamodb:PutItem");
         table.grant(productAttributionFn, "dynamodb:UpdateItem");
+        routingStatsTable.grant(productAttributionFn, "dynamodb:UpdateItem");
+        routingStatsTable.grant(genericAttributionFn, "dynamodb:UpdateItem");
         table.grant(imageGenerationTryOn, "dynamodb:UpdateItem");
+        for (const fn of [labelDetectionFn, productAttributionFn, genericAttributionFn, imageGenerationTryOn]) {
+            ledgerTable.grant(fn, "dynamodb:PutItem");
+        }
+
+        // Offline bulk attribution with Bedrock batch inference, reusing the product attribution code
+        const batchInferenceRole = new Role(this, "BatchInferenceRole", {
+            assumedBy: new ServicePrincipal("bedrock.amazonaws.com")
+        });
+        imagesBucket.grantRead(batchInferenceRole, "input/*");
+        imagesBucket.grantReadWrite(batchInferenceRole, "batch/*");
+        batchInferenceRole.addToPolicy(new PolicyStatement({
+            actions: ["bedrock:InvokeModel"],
+            resources: ["arn:aws:bedrock:" + Aws.REGION + "::foundation-model/" + textModelId]
+        }));
+        const batchAttributionFn = new Function(this, "BatchAttributionFn", {
+            code: Code.fromAsset("./aws-lambda/product-attribution"),
+            handler: "batch.lambda_handler",
+            runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
+            environment: {
+                "ImageBucketName": imagesBucket.bucketName,
+                "ModelId": textModelId,
+                "TableName": table.tableName,
+                "LabelCacheTableName": labelCacheTable.tableName,
+                "BatchBackend": "bedrock",
+                "BatchRoleArn": batchInferenceRole.roleArn,
+                // Records per input file and per job, below the batch inference quotas of the account
+                "BatchChunkSize": "1000",
+                "BatchRecordsPerJob": "50000",
+                "BatchMinRecordsPerJob": "100"
+            },
+            memorySize: 1024,
+            timeout: Duration.minutes(15)
+        });
+        batchAttributionFn.addToRolePolicy(new PolicyStatement({
+            actions: ["bedrock:CreateModelInvocationJob", "bedrock:GetModelInvocationJob"],
+            resources: ["*"]
+        }));
+        batchAttributionFn.addToRolePolicy(new PolicyStatement({
+            actions: ["rekognition:DetectLabels"],
+            resources: ["*"]
+        }));
+        batchInferenceRole.grantPassRole(batchAttributionFn.role!);
+        imagesBucket.grantRead(batchAttributionFn, "input/*");
+        imagesBucket.grantReadWrite(batchAttributionFn, "batch/*");
+        labelCacheTable.grantReadWriteData(batchAttributionFn);
+        table.grant(batchAttributionFn, "dynamodb:PutItem");
+        table.grant(batchAttributionFn, "dynamodb:UpdateItem");
+
+        const batchStepFn = new StateMachine(this, "batchAttributionStateMachine", {
+            timeout: Duration.hours(48),
+            definitionBody: DefinitionBody.fromFile("./workflow-batch.asl.json"),
+            definitionSubstitutions: {
+                "BatchAttributionFnArn": batchAttributionFn.functionArn
+            },
+            tracingEnabled: true,
+            logs: {level: LogLevel.ALL, includeExecutionData: false, destination: logGroup}
+        });
+        batchAttributionFn.grantInvoke(batchStepFn);
+
+        // Starts the execution once the browser uploaded the images and the request manifest directly to S3
+        const uploadCompletionFn = new Function(this, "UploadCompletionFn", {
+            code: Code.fromAsset("./aws-lambda/upload-completion"),
+            handler: "app.lambda_handler",
+            runtime: Runtime.PYTHON_3_13,
+            layers: [sharedLayer],
+            environment: {
+                "StateMachineArn": stepFn.stateMachineArn,
+                "AttributionStateMachineArn": attrStepFn.stateMachineArn
+            },
+            timeout: Duration.seconds(30)
+        });
+        imagesBucket.grantRead(uploadCompletionFn, "input/*");
+        stepFn.grantStartExecution(uploadCompletionFn);
+        attrStepFn.grantStartExecution(uploadCompletionFn);
+        imagesBucket.addEventNotification(EventType.OBJECT_CREATED, new LambdaDestination(uploadCompletionFn),
+            {prefix: "input/requests/", suffix: ".json"});
 
         // Add CloudFormation outputs for local development
         new CfnOutput(this, 'ImageBucketName', {
@@ -176,6 +399,16 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             description: 'ARN of the Step Function state machine'
         });
 
+        new CfnOutput(this, 'BatchAttributionStateMachineArn', {
+            value: batchStepFn.stateMachineArn,
+            description: 'ARN of the Step Function state machine for offline bulk attribution'
+        });
+
+        new CfnOutput(this, 'LedgerTableName', {
+            value: ledgerTable.tableName,
+            description: 'Name of the DynamoDB usage ledger table for tools/ledger_report.py'
+        });
+
         new CfnOutput(this, 'TableName', {
             value: table.tableName,
             description: 'Name of the DynamoDB table for product drafts'
@@ -267,9 +500,11 @@ export class AutomatedProductCatalogStack extends cdk.Stack {
             `docker run -d --name streamlit -p 8501:8501 \\
             -e AWS_REGION=${Aws.REGION} \\
             -e StateMachineArn=${stepFn.stateMachineArn} \\
+            -e AttributionStateMachineArn=${attrStepFn.stateMachineArn} \\
             -e ImageBucketName=${imagesBucket.bucketName} \\
             -e TableName=${table.tableName} \\
             -e IS_LOCAL=true \\
+            -e DIRECT_UPLOAD=true \\
             ${dockerImageUri}`
         );
 
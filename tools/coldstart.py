@@ -0,0 +1,227 @@
+"""
+Cold start profiling of the Python Lambda functions
+
+    python tools/coldstart.py profile aws-lambda/image-try-on
+        Import time breakdown of the function module (python -X importtime), by top level package
+
+    python tools/coldstart.py benchmark aws-lambda/image-try-on --runs 20
+        Cold start latency, the import of the function module plus its first handler invocation, in fresh
+        interpreters for StartupMode eager and lazy
+
+The function dependencies (boto3, Pillow, imagesize, numpy) must be installed in the running interpreter.
+No AWS calls are made, the benchmark points the clients to a local stub endpoint (AWS_ENDPOINT_URL) returning
+canned responses, so client creation, request serialization and response parsing are part of the measurement.
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "aws-lambda")
+sys.path.append(os.path.join(root, "shared", "python"))
+
+from labels import summarize_labels  # noqa: E402
+
+# Environment the functions read at import time
+function_env = {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "coldstart",
+    "AWS_SECRET_ACCESS_KEY": "coldstart",
+    "ModelId": "amazon.nova-pro-v1:0",
+    "ImageBucketName": "coldstart-bucket",
+    "TableName": "coldstart-table",
+    "LabelCacheTableName": "coldstart-label-cache",
+    "PYTHONPATH": os.path.join(root, "shared", "python"),
+    "PYTHONDONTWRITEBYTECODE": "1"
+}
+
+detect_labels_response = {
+    "Labels": [
+        {"Name": "Shirt", "Confidence": 99.0, "Aliases": [], "Categories": [{"Name": "Apparel and Accessories"}],
+         "Parents": [{"Name": "Clothing"}],
+         "Instances": [{"BoundingBox": {"Width": 0.6, "Height": 0.7, "Left": 0.2, "Top": 0.1}, "Confidence": 98.0,
+                        "DominantColors": [{"HexCode": "#1f3a5f", "PixelPercent": 60.0}]}]},
+        {"Name": "Clothing", "Confidence": 99.0, "Aliases": [{"Name": "Apparel"}],
+         "Categories": [{"Name": "Apparel and Accessories"}], "Parents": [], "Instances": []}
+    ]
+}
+
+influences = {
+    "isPromoted": False, "influenceBrandVoice": "", "influenceBrandStrength": "", "influencePrice": "",
+    "influenceImagePose": "standing", "influenceImageEmotion": "smiling", "influenceImageBodyStructure": "athletic",
+    "influenceImageNumImages": 1, "influenceGender": "female"
+}
+
+# First invocation event of each function
+events = {
+    "label-detection": {"id": "coldstart", "path": "input/coldstart.png"},
+    "product-attribution": {"executionId": "coldstart", "data": dict(
+        influences, id="coldstart", path="input/coldstart.png",
+        labels=summarize_labels(detect_labels_response["Labels"]))},
+    "generic-attribution": {"executionId": "coldstart", "data": {
+        "id": "coldstart", "useCase": "hospitality", "paths": ["input/coldstart.png"]}},
+    "image-try-on": dict(influences, id="coldstart", path="input/coldstart.png", label="Shirt",
+                         boundingBox=detect_labels_response["Labels"][0]["Instances"][0]["BoundingBox"])
+}
+
+
+def png(width, height, pixel):
+    # Uncompressed RGB PNG of pixel(x, y), without an image library
+    rows = b"".join(b"\x00" + b"".join(bytes(pixel(x, y)) for x in range(width)) for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+image = png(64, 64, lambda x, y: ((x * 4) % 256, (y * 4) % 256, ((x ^ y) * 8) % 256))
+mask = png(64, 64, lambda x, y: (0, 0, 0) if 16 <= x < 48 and 12 <= y < 56 else (255, 255, 255))
+converse_response = {
+    "output": {"message": {"role": "assistant", "content": [{"text": json.dumps(
+        {"garment_type": "UPPER_BODY", "Title": "Shirt", "Description": "Cotton shirt", "room_type": "double"})}]}},
+    "stopReason": "end_turn",
+    "usage": {"inputTokens": 1000, "outputTokens": 100, "totalTokens": 1100},
+    "metrics": {"latencyMs": 1}
+}
+invoke_response = {"images": [base64.b64encode(image).decode("utf-8")],
+                   "maskImage": base64.b64encode(mask).decode("utf-8")}
+
+
+class StubEndpoint(BaseHTTPRequestHandler):
+    """
+    Canned responses of the S3, DynamoDB, Rekognition and Bedrock Runtime requests of the functions
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, body=b"", content_type="application/json", headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        if "Content-Length" in self.headers:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        self.close_connection = True
+        return b""
+
+    def do_HEAD(self):
+        self.respond(image, "image/png", {"ETag": '"coldstart"'})
+
+    def do_GET(self):
+        self.respond(image, "image/png", {"ETag": '"coldstart"'})
+
+    def do_PUT(self):
+        self.read_body()
+        self.respond(headers={"ETag": '"coldstart"'})
+
+    def do_POST(self):
+        request = self.read_body()
+        target = self.headers.get("X-Amz-Target", "")
+        if target.endswith(".DetectLabels"):
+            body = detect_labels_response
+        elif target:
+            # DynamoDB, e.g. a GetItem cache miss or an UpdateItem without return values
+            body = {}
+        elif self.path.endswith("/converse"):
+            body = converse_response
+        elif self.path.endswith("/invoke"):
+            # Nova Canvas only returns the mask of a virtual try-on when it is requested
+            params = json.loads(request or b"{}").get("virtualTryOnParams", {})
+            body = invoke_response if params.get("returnMask") else {"images": invoke_response["images"]}
+        else:
+            body = {}
+        self.respond(json.dumps(body).encode("utf-8"), "application/x-amz-json-1.1")
+
+
+def module_name(function_dir):
+    return "index" if os.path.exists(os.path.join(function_dir, "index.py")) else "app"
+
+
+def run(function_dir, code, startup_mode="lazy", extra_args=(), extra_env=None, argv=()):
+    env = dict(os.environ, **function_env, **(extra_env or {}), StartupMode=startup_mode)
+    return subprocess.run([sys.executable, *extra_args, "-c", code, *argv], cwd=function_dir, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def profile(function_dir, startup_mode, top):
+    result = run(function_dir, f"import {module_name(function_dir)}", startup_mode, ["-X", "importtime"])
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # Self times summed per top level package, cumulative times would count nested imports twice
+        own, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(own)
+    total = sum(packages.values())
+    print(f"{'package':<30} {'ms':>8} {'share':>7}")
+    for package, micros in sorted(packages.items(), key=lambda p: p[1], reverse=True)[:top]:
+        print(f"{package:<30} {micros / 1000:>8.1f} {micros / total:>7.1%}")
+    print(f"{'total':<30} {total / 1000:>8.1f}")
+
+
+def benchmark(function_dir, runs):
+    name = os.path.basename(function_dir.rstrip(os.sep))
+    if name not in events:
+        raise SystemExit(f"No benchmark event for {name}, one of {', '.join(events)}")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    code = ("import json, sys, time\n"
+            "class Context:\n"
+            "    memory_limit_in_mb = 128\n"
+            "    def get_remaining_time_in_millis(self):\n"
+            "        return 900000\n"
+            "start = time.perf_counter()\n"
+            f"import {module_name(function_dir)} as function\n"
+            "init = time.perf_counter()\n"
+            "function.lambda_handler(json.loads(sys.argv[1]), Context())\n"
+            "print(json.dumps([init - start, time.perf_counter() - init]))")
+    env = {"AWS_ENDPOINT_URL": f"http://127.0.0.1:{server.server_port}"}
+    try:
+        print(f"{'mode':<6} {'init ms':>9} {'first call ms':>14} {'total ms':>9} {'total p90 ms':>13}")
+        for startup_mode in ["eager", "lazy"]:
+            # The handlers log to stdout, the durations are the last line
+            results = [json.loads(run(function_dir, code, startup_mode, extra_env=env,
+                                      argv=[json.dumps(events[name])]).stdout.splitlines()[-1])
+                       for _ in range(runs)]
+            init = [r[0] * 1000 for r in results]
+            first_call = [r[1] * 1000 for r in results]
+            totals = sorted(i + c for i, c in zip(init, first_call))
+            print(f"{startup_mode:<6} {statistics.median(init):>9.1f} {statistics.median(first_call):>14.1f} "
+                  f"{statistics.median(totals):>9.1f} {totals[int(0.9 * (len(totals) - 1))]:>13.1f}")
+    finally:
+        server.shutdown()
+    print(f"Medians of {runs} runs, the first call includes what the lazy mode defers from the init phase")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start profiling of the Python Lambda functions")
+    parser.add_argument("command", choices=["profile", "benchmark"])
+    parser.add_argument("function_dir", help="Function directory e.g. aws-lambda/image-try-on")
+    parser.add_argument("--startup-mode", default="eager", choices=["eager", "lazy"], help="StartupMode to profile")
+    parser.add_argument("--top", type=int, default=15, help="Number of packages in the profile")
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh interpreters per benchmark mode")
+    args = parser.parse_args()
+
+    if args.command == "profile":
+        profile(os.path.abspath(args.function_dir), args.startup_mode, args.top)
+    else:
+        benchmark(os.path.abspath(args.function_dir), args.runs)
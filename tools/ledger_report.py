@@ -0,0 +1,196 @@
+"""
+Cost, throughput and capacity headroom report of the usage ledger
+
+    python tools/ledger_report.py --table <LedgerTableName> --hours 24 --window 60
+        Report of the DynamoDB ledger table for the last 24 hours in 60 minute windows
+
+    python tools/ledger_report.py --sqlite ledger.db --quotas quotas.json --lambda-concurrency 1000
+        Report of the local SQLite ledger (LedgerSqlitePath), with headroom against the given limits
+
+quotas.json maps model ids to tokens and requests per minute, e.g.
+    {"amazon.nova-pro-v1:0": {"tokensPerMinute": 1000000, "requestsPerMinute": 200}}
+
+Prices default to on-demand list prices in USD and can be overridden with --prices prices.json in the format
+of default_prices. Usage is attributed to the minute a record was written, the end of the invocation, so
+peaks of long invocations are approximate.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+default_prices = {
+    "models": {
+        "amazon.nova-pro-v1:0": {"inputTokens": 0.0008 / 1000, "outputTokens": 0.0032 / 1000},
+        "amazon.nova-lite-v1:0": {"inputTokens": 0.00006 / 1000, "outputTokens": 0.00024 / 1000},
+        "amazon.nova-canvas-v1:0": {"images": 0.04}
+    },
+    "rekognitionCall": 0.001,
+    "lambdaGbSecond": 0.0000166667,
+    "lambdaRequest": 0.0000002
+}
+
+
+def from_attribute(value):
+    if "M" in value:
+        return {k: from_attribute(v) for k, v in value["M"].items()}
+    if "N" in value:
+        number = float(value["N"])
+        return int(number) if number.is_integer() else number
+    return value.get("S")
+
+
+def days(since, until):
+    day = since - since % 86400
+    while day <= until:
+        yield time.strftime("%Y-%m-%d", time.gmtime(day))
+        day += 86400
+
+
+def load_dynamodb(table, region, since, until):
+    import boto3
+    ddb = boto3.client("dynamodb", region_name=region)
+    paginator = ddb.get_paginator("query")
+    for day in days(since, until):
+        pages = paginator.paginate(TableName=table, KeyConditionExpression="#d = :d",
+                                   ExpressionAttributeNames={"#d": "Day"}, ExpressionAttributeValues={":d": {"S": day}})
+        for page in pages:
+            for item in page["Items"]:
+                yield {k: from_attribute(v) for k, v in item.items()}
+
+
+def load_sqlite(path, since, until):
+    with sqlite3.connect(path) as connection:
+        placeholders = ",".join("?" * len(list(days(since, until))))
+        for (record,) in connection.execute(f"SELECT record FROM ledger WHERE day IN ({placeholders})",
+                                            list(days(since, until))):
+            yield json.loads(record)
+
+
+def record_cost(record, prices):
+    # Cost of one invocation, per model and in total
+    model_costs = {}
+    for model_id, usage in record.get("Models", {}).items():
+        price = prices["models"].get(model_id, {})
+        model_costs[model_id] = (usage.get("InputTokens", 0) * price.get("inputTokens", 0)
+                                 + usage.get("OutputTokens", 0) * price.get("outputTokens", 0)
+                                 + usage.get("Images", 0) * price.get("images", 0))
+    lambda_cost = (record.get("DurationMs", 0) / 1000 * record.get("MemoryMb", 0) / 1024 * prices["lambdaGbSecond"]
+                   + prices["lambdaRequest"])
+    total = sum(model_costs.values()) + lambda_cost + record.get("RekognitionCalls", 0) * prices["rekognitionCall"]
+    return model_costs, total
+
+
+def headroom(peak, limit):
+    return f"{1 - peak / limit:.0%}" if limit else "-"
+
+
+def print_table(title, header, rows):
+    print(f"\n{title}")
+    widths = [max(len(str(c)) for c in column) for column in zip(header, *rows)]
+    for row in [header, *rows]:
+        print("  ".join(str(c).rjust(w) if i else str(c).ljust(w) for i, (c, w) in enumerate(zip(row, widths))))
+
+
+def report(records, prices, quotas, lambda_concurrency, window_minutes):
+    models = defaultdict(lambda: defaultdict(float))
+    model_minutes = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    categories = defaultdict(lambda: {"ids": set(), "cost": 0.0, "duration": 0, "invocations": 0})
+    windows = defaultdict(lambda: {"ids": set(), "cost": 0.0, "invocations": 0, "errors": 0})
+    concurrency_minutes = defaultdict(float)
+
+    for record in records:
+        model_costs, cost = record_cost(record, prices)
+        minute = int(record["RecordedAt"] // 60)
+        for model_id, usage in record.get("Models", {}).items():
+            for k in ("Requests", "InputTokens", "OutputTokens", "Images"):
+                models[model_id][k] += usage.get(k, 0)
+            models[model_id]["cost"] += model_costs[model_id]
+            model_minutes[model_id][minute][0] += usage.get("InputTokens", 0) + usage.get("OutputTokens", 0)
+            model_minutes[model_id][minute][1] += usage.get("Requests", 0)
+
+        category = categories[(record.get("Category", "unknown"), record["Function"])]
+        category["ids"].add(record["Id"])
+        category["cost"] += cost
+        category["duration"] += record.get("DurationMs", 0)
+        category["invocations"] += 1
+
+        window = windows[int(record["RecordedAt"] // (window_minutes * 60))]
+        window["ids"].add(record["Id"])
+        window["cost"] += cost
+        window["invocations"] += 1
+        window["errors"] += record.get("Status") == "error"
+        # Average concurrent executions of the minute, Lambda concurrency is duration per second of wall time
+        concurrency_minutes[minute] += record.get("DurationMs", 0) / 60000
+
+    rows = []
+    for model_id, totals in sorted(models.items()):
+        peak_tokens = max(m[0] for m in model_minutes[model_id].values())
+        peak_requests = max(m[1] for m in model_minutes[model_id].values())
+        quota = quotas.get(model_id, {})
+        rows.append([model_id, int(totals["Requests"]), int(totals["InputTokens"]), int(totals["OutputTokens"]),
+                     int(totals["Images"]), f"{totals['cost']:.4f}", peak_tokens, peak_requests,
+                     headroom(peak_tokens, quota.get("tokensPerMinute")),
+                     headroom(peak_requests, quota.get("requestsPerMinute"))])
+    print_table("Per model", ["model", "requests", "input tokens", "output tokens", "images", "cost $",
+                              "peak TPM", "peak RPM", "TPM headroom", "RPM headroom"], rows)
+
+    rows = []
+    for (category, function), totals in sorted(categories.items()):
+        items = len(totals["ids"])
+        rows.append([category, function, items, totals["invocations"], f"{totals['cost']:.4f}",
+                     f"{totals['cost'] / items:.5f}", f"{totals['duration'] / totals['invocations'] / 1000:.1f}"])
+    print_table("Per category", ["category", "function", "items", "invocations", "cost $", "cost per item $",
+                                 "avg duration s"], rows)
+
+    rows = []
+    for window, totals in sorted(windows.items()):
+        start = window * window_minutes * 60
+        minutes = range(start // 60, start // 60 + window_minutes)
+        peak_concurrency = max(concurrency_minutes.get(m, 0) for m in minutes)
+        rows.append([time.strftime("%Y-%m-%d %H:%M", time.gmtime(start)), len(totals["ids"]),
+                     f"{len(totals['ids']) / window_minutes * 60:.1f}", totals["invocations"], totals["errors"],
+                     f"{totals['cost']:.4f}", f"{peak_concurrency:.2f}", headroom(peak_concurrency, lambda_concurrency)])
+    print_table(f"Per {window_minutes} minute window (UTC)",
+                ["window", "items", "items/hour", "invocations", "errors", "cost $", "peak concurrency",
+                 "concurrency headroom"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--table", help="DynamoDB ledger table name")
+    source.add_argument("--sqlite", help="SQLite ledger database path")
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    parser.add_argument("--hours", type=float, default=24, help="Time span of the report, ending now")
+    parser.add_argument("--window", type=int, default=60, help="Window length in minutes")
+    parser.add_argument("--prices", help="JSON file overriding the default prices")
+    parser.add_argument("--quotas", help="JSON file with tokens and requests per minute per model")
+    parser.add_argument("--lambda-concurrency", type=int, default=0, help="Account Lambda concurrency limit")
+    args = parser.parse_args()
+
+    until = time.time()
+    since = until - args.hours * 3600
+    records = load_dynamodb(args.table, args.region, since, until) if args.table else \
+        load_sqlite(args.sqlite, since, until)
+    records = [r for r in records if since <= r["RecordedAt"] <= until]
+    if not records:
+        print("No usage records in the time span")
+        return
+
+    prices = default_prices
+    if args.prices:
+        with open(args.prices) as file:
+            prices = dict(default_prices, **json.load(file))
+    quotas = {}
+    if args.quotas:
+        with open(args.quotas) as file:
+            quotas = json.load(file)
+    print(f"{len(records)} usage records from {time.strftime('%Y-%m-%d %H:%M', time.gmtime(since))} UTC")
+    report(records, prices, quotas, args.lambda_concurrency, args.window)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Precompile the prompt templates of the Lambda functions into templates.json
+
+Each aws-lambda/<function>/<name>-template.txt is stored with its parsed attribute schema in
+aws-lambda/<function>/templates.json with the SHA-256 of the template text, so the functions
+skip parsing the template on a cold start. Templates changed since the last run are parsed again
+by the functions, run before `cdk deploy` whenever a template changes.
+"""
+import glob
+import json
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "aws-lambda")
+sys.path.insert(0, os.path.join(root, "shared", "python"))
+
+from model_routing import template_schema  # noqa: E402
+from startup import template_digest  # noqa: E402
+
+
+def precompile(function_dir):
+    templates = {}
+    for path in sorted(glob.glob(os.path.join(function_dir, "*-template.txt"))):
+        name = os.path.basename(path).replace("-template.txt", "")
+        with open(path, "r") as file:
+            template = file.read()
+        templates[name] = {"sha256": template_digest(template), "schema": template_schema(template)}
+    if templates:
+        with open(os.path.join(function_dir, "templates.json"), "w") as file:
+            json.dump(templates, file, indent=1)
+        print(f"{os.path.relpath(function_dir)}: {', '.join(templates)}")
+
+
+if __name__ == "__main__":
+    for function_dir in sorted(glob.glob(os.path.join(root, "*"))):
+        if os.path.isdir(function_dir):
+            precompile(function_dir)
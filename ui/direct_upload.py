@@ -0,0 +1,100 @@
+import json
+import os
+
+import boto3
+from botocore.config import Config
+import streamlit.components.v1 as components
+
+# Browser uploads straight to S3 with presigned POSTs, the upload-completion Lambda starts the
+# execution once the browser has written the request manifest after all images
+direct_upload_enabled = os.environ.get("DIRECT_UPLOAD", "false").lower() == "true"
+max_upload_bytes = 20 * 1024 * 1024
+presign_expiry_seconds = 900
+
+# Virtual addressing gives the regional <bucket>.s3.<region>.amazonaws.com endpoint, the global endpoint
+# answers new buckets outside us-east-1 with a redirect that browser POSTs do not follow
+s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"], config=Config(s3={"addressing_style": "virtual"}))
+
+
+def presigned_post(bucket, key_prefix):
+    # Any key starting with key_prefix, the browser picks the extension of the selected file
+    return s3.generate_presigned_post(
+        Bucket=bucket,
+        Key=key_prefix + "${filename}",
+        Conditions=[["content-length-range", 1, max_upload_bytes]],
+        ExpiresIn=presign_expiry_seconds
+    )
+
+
+def render_direct_upload(bucket, current_id, workflow, workflow_input, slots, done_url):
+    """
+    Render file pickers uploading directly from the browser to S3, in parallel
+
+    Args:
+        bucket: Image bucket name
+        current_id: Id of the item, also the execution name
+        workflow: Workflow started by the upload-completion Lambda, "catalog" or "attribution"
+        workflow_input: Execution input, completed with the uploaded keys of each slot
+        slots: List of dicts with field (execution input field), label, key_prefix, required and max_files
+            (more than 1 makes the field a list of keys)
+        done_url: Page opened after the uploads completed
+    """
+    for slot in slots:
+        slot["post"] = presigned_post(bucket, slot["key_prefix"])
+    manifest_post = presigned_post(bucket, f"input/requests/{current_id}")
+
+    config = json.dumps({
+        "slots": slots,
+        "manifestPost": manifest_post,
+        "manifest": {"id": current_id, "workflow": workflow, "input": workflow_input},
+        "maxBytes": max_upload_bytes,
+        "doneUrl": done_url
+    })
+    components.html("""
+<div id="slots" style="font-family: sans-serif"></div>
+<button id="upload" style="margin-top: 8px">Upload and start</button>
+<p id="status" style="font-family: sans-serif"></p>
+<script>
+const config = %s;
+const container = document.getElementById("slots");
+config.slots.forEach((slot, i) => {
+  container.insertAdjacentHTML("beforeend",
+    `<p><label>${slot.label}<br><input type="file" id="slot${i}" accept=".jpg,.jpeg,.png"` +
+    `${slot.max_files > 1 ? " multiple" : ""}></label></p>`);
+});
+const status = document.getElementById("status");
+
+async function post(presigned, key, body) {
+  const form = new FormData();
+  Object.entries(presigned.fields).forEach(([k, v]) => form.append(k, k === "key" ? key : v));
+  form.append("file", body);
+  const response = await fetch(presigned.url, {method: "POST", body: form});
+  if (!response.ok) throw new Error(`Upload of ${key} failed with ${response.status}`);
+}
+
+document.getElementById("upload").onclick = async () => {
+  const uploads = [];
+  const input = Object.assign({}, config.manifest.input);
+  for (const [i, slot] of config.slots.entries()) {
+    const files = Array.from(document.getElementById(`slot${i}`).files).slice(0, slot.max_files);
+    if (slot.required && files.length === 0) { status.textContent = `${slot.label} is required`; return; }
+    if (files.some(f => f.size > config.maxBytes)) { status.textContent = "File too large"; return; }
+    const keys = files.map((f, n) =>
+      slot.key_prefix + (slot.max_files > 1 ? `_${n + 1}` : "") + "." + f.name.split(".").pop().toLowerCase());
+    files.forEach((f, n) => uploads.push(post(slot.post, keys[n], f)));
+    if (files.length > 0) input[slot.field] = slot.max_files > 1 ? keys : keys[0];
+  }
+  status.textContent = `Uploading ${uploads.length} file(s)...`;
+  try {
+    await Promise.all(uploads);
+    // The manifest is written last, its upload triggers the execution
+    const manifest = Object.assign({}, config.manifest, {input: input});
+    await post(config.manifestPost, `input/requests/${manifest.id}.json`,
+               new Blob([JSON.stringify(manifest)], {type: "application/json"}));
+    status.innerHTML = `Uploaded, <a href="${config.doneUrl}" target="_top">view progress</a>`;
+  } catch (e) {
+    status.textContent = e.message;
+  }
+};
+</script>
+""" % config, height=120 + 90 * len(slots))
@@ -3,6 +3,7 @@ import json
 import os
 import streamlit as st
 import uuid
+from direct_upload import direct_upload_enabled, render_direct_upload
 
 st.set_page_config(layout="wide")
 
@@ -28,8 +29,22 @@ def format_body_structure_labels(label):
     return label
 
 with col1:
-    uploaded_file = st.file_uploader("Input image", type=["jpg", "jpeg", "png"])
-    human_model_image = st.file_uploader("Human image (AI Generated if not provided)", type=["jpg", "jpeg", "png"])
+    if direct_upload_enabled:
+        # Images are picked and uploaded from the browser once the parameters are submitted
+        uploaded_file, human_model_image = None, None
+        if "direct_upload" in st.session_state:
+            upload = st.session_state["direct_upload"]
+            render_direct_upload(bucket, upload["id"], "catalog", upload["input"], [
+                {"field": "path", "label": "Input image", "key_prefix": f"input/{upload['id']}",
+                 "required": True, "max_files": 1},
+                {"field": "humanModel", "label": "Human image (AI Generated if not provided)",
+                 "key_prefix": f"input/{upload['id']}_model", "required": False, "max_files": 1}
+            ], f"/outputs?current_id={upload['id']}")
+        else:
+            st.info("Submit the parameters to upload the input images")
+    else:
+        uploaded_file = st.file_uploader("Input image", type=["jpg", "jpeg", "png"])
+        human_model_image = st.file_uploader("Human image (AI Generated if not provided)", type=["jpg", "jpeg", "png"])
     if uploaded_file is not None:
         image_bytes = uploaded_file.read()
         ext = uploaded_file.name.split(".")[-1]
@@ -53,14 +68,25 @@ with col2:
         output_images = st.slider('Number of output images', 1, 5, 2)
         submitted = st.form_submit_button("Submit")
 
-        if submitted:
+        if submitted and direct_upload_enabled:
+            current_id = str(uuid.uuid4())
+            st.session_state["direct_upload"] = {"id": current_id, "input": {
+                "id": current_id, "influenceImagePose": pose, "influenceImageBodyStructure": body,
+                "influenceImageEmotion": emotion, "influenceBrandStrength": strength,
+                "influenceBrandVoice": voice,
+                "influenceGender": gender,
+                "influencePrice": pricing_influence, "isPromoted": promoted,
+                "influenceImageNumImages": output_images}}
+            st.session_state['current_id'] = current_id
+            st.rerun()
+        elif submitted:
             current_id = str(uuid.uuid4())
             path = f"input/{current_id}.{ext}"
             print("Uploading file to path: " + path)
             s3.put_object(Bucket=bucket, Key=path, Body=image_bytes)
             if human_model_image is not None:
                 s3.put_object(Bucket=bucket, Key=f"input/{current_id}_model.jpg", Body=human_model_image_bytes)
-                execution = steps.start_execution(stateMachineArn=state_machine_arn, input=json.dumps(
+                execution = steps.start_execution(stateMachineArn=state_machine_arn, name=current_id, input=json.dumps(
                     {"id": current_id, "path": path, "influenceImagePose": pose, "influenceImageBodyStructure": body,
                      "influenceImageEmotion": emotion, "influenceBrandStrength": strength,
                      "influenceBrandVoice": voice,
@@ -69,7 +95,7 @@ with col2:
                      "influencePrice": pricing_influence, "isPromoted": promoted,
                      "influenceImageNumImages": output_images}))
             else:
-                execution = steps.start_execution(stateMachineArn=state_machine_arn, input=json.dumps(
+                execution = steps.start_execution(stateMachineArn=state_machine_arn, name=current_id, input=json.dumps(
                     {"id": current_id, "path": path, "influenceImagePose": pose, "influenceImageBodyStructure": body,
                      "influenceImageEmotion": emotion, "influenceBrandStrength": strength,
                      "influenceBrandVoice": voice,
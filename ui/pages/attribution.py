@@ -5,6 +5,7 @@ import json
 import os
 import streamlit as st
 import uuid
+from direct_upload import direct_upload_enabled, render_direct_upload
 
 st.set_page_config(layout="wide")
 
@@ -27,15 +28,21 @@ with col1:
     with st.form("Parameters"):
         current_id = str(uuid.uuid4())
         use_case = st.selectbox('Use case', ['Hospitality'], 0)
-        input_images = st.file_uploader(
-            "Upload images (up to 5)", 
-            type=["jpg", "jpeg", "png"], 
-            accept_multiple_files=True,
-            help="Select up to 5 images for attribution analysis"
-        )
+        input_images = None
+        if not direct_upload_enabled:
+            input_images = st.file_uploader(
+                "Upload images (up to 5)",
+                type=["jpg", "jpeg", "png"],
+                accept_multiple_files=True,
+                help="Select up to 5 images for attribution analysis"
+            )
 
         submitted = st.form_submit_button("Submit")
-        if submitted:
+        if submitted and direct_upload_enabled:
+            # Images are picked and uploaded from the browser, the execution starts once they are uploaded
+            st.session_state["direct_upload_attribution"] = {"id": current_id, "input": {
+                "id": current_id, "useCase": use_case}}
+        elif submitted:
             paths = []
             if input_images:
                 # Limit to maximum 5 files
@@ -56,9 +63,20 @@ with col1:
             else:
                 st.error("Please upload at least one image before submitting.")
 
+    if direct_upload_enabled and "direct_upload_attribution" in st.session_state:
+        upload = st.session_state["direct_upload_attribution"]
+        render_direct_upload(bucket, upload["id"], "attribution", upload["input"], [
+            {"field": "paths", "label": "Upload images (up to 5)",
+             "key_prefix": f"input/attributions/{upload['id']}", "required": True, "max_files": 5}
+        ], f"/attribution?current_id={upload['id']}")
+
 with col2:
     attribution = st.empty()
 
+# Follow an execution started by a direct upload
+if "current_id" in st.query_params:
+    current_id = st.query_params["current_id"]
+
 
 async def async_updates():
     st.session_state["WrittenKeys"] = []
@@ -0,0 +1,158 @@
+import asyncio
+import boto3
+import json
+import os
+import pandas as pd
+import streamlit as st
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+st.set_page_config(layout="wide")
+
+region = os.environ["AWS_REGION"]
+state_machine_arn = os.environ["StateMachineArn"]
+table = os.environ["TableName"]
+sfn = boto3.client("stepfunctions", region_name=region)
+ddb = boto3.client("dynamodb", region_name=region)
+
+max_executions = 1000
+throughput_window = timedelta(minutes=15)
+failed_statuses = ["FAILED", "TIMED_OUT", "ABORTED"]
+
+
+@st.cache_data(ttl=10, show_spinner=False)
+def list_executions(arn, max_items):
+    # Listing is shared by all dashboard sessions and refreshed at most every 10 seconds
+    executions = []
+    paginator = sfn.get_paginator("list_executions")
+    for page in paginator.paginate(stateMachineArn=arn, PaginationConfig={"MaxItems": max_items, "PageSize": 100}):
+        for e in page["executions"]:
+            executions.append({k: e.get(k) for k in ["executionArn", "name", "status", "startDate", "stopDate"]})
+    return executions
+
+
+@st.cache_data(show_spinner=False)
+def execution_item_id(execution_arn, name):
+    # Executions started by inputs.py are named after the item Id, older ones need their input
+    try:
+        return str(uuid.UUID(name))
+    except ValueError:
+        response = sfn.describe_execution(executionArn=execution_arn, includedData='ALL_DATA')
+        return json.loads(response["input"]).get("id", name)
+
+
+def batch_get_progress(ids):
+    # BatchGetItem accepts up to 100 keys per request, unprocessed keys are retried with exponential backoff
+    items = {}
+    ids = list(ids)
+    for i in range(0, len(ids), 100):
+        request = {table: {
+            "Keys": [{"Id": {"S": item_id}} for item_id in ids[i:i + 100]],
+            "ProjectionExpression": "Id, Progress, CurrentStep, StartedAt, AttributedAt, ImagesGeneratedAt"
+        }}
+        attempt = 0
+        while request:
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            resp = ddb.batch_get_item(RequestItems=request)
+            for item in resp["Responses"].get(table, []):
+                items[item["Id"]["S"]] = item
+            request = resp.get("UnprocessedKeys")
+            attempt += 1
+    return items
+
+
+def number(item, key):
+    if key in item:
+        return float(item[key]["N"])
+    return None
+
+
+c1 = st.container()
+c1.title("Catalog Runs Dashboard")
+metrics = st.empty()
+latency_chart = st.empty()
+in_flight_table = st.empty()
+failures_table = st.empty()
+
+if "DashboardItems" not in st.session_state:
+    st.session_state["DashboardItems"] = {}
+    st.session_state["DashboardFetchedStatus"] = {}
+
+
+async def async_updates():
+    max_iterations = 120
+    while max_iterations > 0:
+        max_iterations -= 1
+        executions = list_executions(state_machine_arn, max_executions)
+        items = st.session_state["DashboardItems"]
+        fetched_status = st.session_state["DashboardFetchedStatus"]
+
+        # Only fetch items of running executions or whose execution status changed since the last fetch,
+        # items of finished executions do not change anymore
+        ids = {e["executionArn"]: execution_item_id(e["executionArn"], e["name"]) for e in executions}
+        stale = [e for e in executions if e["status"] == "RUNNING" or fetched_status.get(e["executionArn"]) != e["status"]]
+        items.update(batch_get_progress({ids[e["executionArn"]] for e in stale}))
+        for e in stale:
+            fetched_status[e["executionArn"]] = e["status"]
+
+        now = datetime.now(timezone.utc)
+        running = [e for e in executions if e["status"] == "RUNNING"]
+        failed = [e for e in executions if e["status"] in failed_statuses]
+        recent = [e for e in executions if e["status"] == "SUCCEEDED" and e["stopDate"] and
+                  now - e["stopDate"] <= throughput_window]
+
+        with metrics.container():
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Executions", len(executions))
+            m2.metric("In flight", len(running))
+            m3.metric("Failed", len(failed))
+            m4.metric("Throughput (per min)", round(len(recent) / (throughput_window.total_seconds() / 60), 2))
+
+        # Per step latencies in seconds
+        latencies = []
+        for e in executions:
+            item = items.get(ids[e["executionArn"]], {})
+            started, attributed, generated = (number(item, k) for k in ["StartedAt", "AttributedAt", "ImagesGeneratedAt"])
+            execution_start = e["startDate"].timestamp()
+            if started:
+                latencies.append({"step": "Label detection", "seconds": started - execution_start})
+            if started and attributed:
+                latencies.append({"step": "Product attribution", "seconds": attributed - started})
+            # Both branches start when label detection ends, which is when the attribution writes StartedAt
+            if started and generated:
+                latencies.append({"step": "Image generation", "seconds": generated - started})
+            if e["status"] == "SUCCEEDED" and e["stopDate"]:
+                latencies.append({"step": "End to end", "seconds": e["stopDate"].timestamp() - execution_start})
+
+        with latency_chart.container():
+            st.subheader("Step latency (seconds)", divider=True)
+            if latencies:
+                df = pd.DataFrame(latencies)
+                st.dataframe(df.groupby("step")["seconds"].describe(percentiles=[.5, .9, .99]).round(2))
+                df["bucket"] = (df["seconds"] // 5 * 5).astype(int)
+                st.bar_chart(df.pivot_table(index="bucket", columns="step", values="seconds", aggfunc="count"))
+
+        with in_flight_table.container():
+            st.subheader("In flight", divider=True)
+            st.dataframe(pd.DataFrame([{
+                "id": ids[e["executionArn"]],
+                "started": e["startDate"],
+                "progress": number(items.get(ids[e["executionArn"]], {}), "Progress"),
+                "step": items.get(ids[e["executionArn"]], {}).get("CurrentStep", {}).get("S", "")
+            } for e in running]), use_container_width=True)
+
+        with failures_table.container():
+            st.subheader("Failures", divider=True)
+            st.dataframe(pd.DataFrame([{
+                "id": ids[e["executionArn"]],
+                "status": e["status"],
+                "started": e["startDate"],
+                "step": items.get(ids[e["executionArn"]], {}).get("CurrentStep", {}).get("S", "")
+            } for e in failed]), use_container_width=True)
+
+        _ = await asyncio.sleep(10)
+
+
+asyncio.run(async_updates())
@@ -30,6 +30,20 @@ else:
         st.error("No running session found. Reload the page after submitting your input form!")
         st.stop()
 
+def display_key(item, key, width):
+    # Prefer the smallest WebP variant of an output image that is at least width pixels wide
+    for derivative in item.get("OutputDerivatives", {}).get("L", []):
+        if derivative["M"]["Image"]["S"] == key:
+            variants = sorted((int(name.split(".")[0]), v["S"])
+                              for name, v in derivative["M"]["Variants"]["M"].items() if name.endswith(".webp"))
+            for variant_width, variant_key in variants:
+                if variant_width >= width:
+                    return variant_key
+            if variants:
+                return variants[-1][1]
+    return key
+
+
 all_states = ["Label and categories generated", "Product Attribution Generated", "Generating images",
               "Images Generated"]
 
@@ -133,7 +147,7 @@ async def async_updates():
                     k = 0
                     for i in item["OutputImages"]["L"]:
                         # Display output image
-                        obj = s3.get_object(Bucket=item["ImageBucket"]["S"], Key=i["S"])
+                        obj = s3.get_object(Bucket=item["ImageBucket"]["S"], Key=display_key(item, i["S"], 256))
                         image_bytes = obj['Body'].read()
                         status_bar_13_splits[k % 2].image(image_bytes)
 
@@ -205,7 +219,7 @@ async def async_updates():
                 img_index = i["S"].split('/')[-1].split('.')[0]
                 display_images[img_index] = {
                     "bucket": item["ImageBucket"]["S"],
-                    "key": i["S"],
+                    "key": display_key(item, i["S"], 1024),
                     "type": "output"
                 }
         